@@ -4,7 +4,7 @@ import networkx as nx
 
 
 def plot_network(network):
-    steven = network
+    steven = network.to_networkx()  # the CSR graph of the CTN
     plt.title('constituent tree network', loc= 'center')
     pos = graphviz_layout(steven, prog='dot')
     edges = steven.edges()
@@ -3,16 +3,17 @@ import math
 import networkx as nx
 
 
-def plot_activation(graph, activation_recorder):
+def plot_activation(dsm, activation_recorder):
     """
     plot the lexical network, where all nodes are words
     """
 
     plt.title('lexical network with activation dispersion', loc= 'center')
 
+    graph = dsm.network.to_networkx()
     color_list = []
     for node in graph:
-        color_list.append(math.log(activation_recorder[0, graph.node_list.index(node)]))
+        color_list.append(math.log(activation_recorder[dsm.node2id[node]]))
 
     vmin = min(color_list)
     vmax = max(color_list)
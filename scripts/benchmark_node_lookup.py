@@ -0,0 +1,45 @@
+"""
+show that looking up a node in a graph DSM does not depend on the size of the graph.
+
+LONs of increasing size are built from random sequences, and the time to look up the row of target nodes
+is compared between the cached node2id index and a linear scan of node_list.
+"""
+
+import time
+import numpy as np
+
+from traindsms.dsms.lon import LON
+from traindsms.params import LONParams
+
+NUM_LOOKUPS = 1_000
+
+
+def main():
+    rng = np.random.default_rng(0)
+    params = LONParams(excluded_tokens=None, context_size=1)
+
+    for num_nodes in [100, 1_000, 10_000]:
+        vocab = [f'w{i}' for i in range(num_nodes)]
+        seq_tok = [list(rng.choice(vocab, size=6)) for _ in range(num_nodes)]
+        dsm = LON(params, seq_tok)
+        dsm.train()
+        targets = list(rng.choice(dsm.node_list, size=NUM_LOOKUPS))
+
+        start = time.perf_counter()
+        for target in targets:
+            dsm.node_list.index(target)
+        time_scan = time.perf_counter() - start
+
+        _ = dsm.node2id  # built once
+        start = time.perf_counter()
+        for target in targets:
+            dsm.node2id[target]
+        time_index = time.perf_counter() - start
+
+        print(f'num_nodes={len(dsm.node_list):>6,} '
+              f'node_list.index={time_scan / NUM_LOOKUPS * 1e6:>8.2f} us/lookup '
+              f'node2id={time_index / NUM_LOOKUPS * 1e6:>6.2f} us/lookup')
+
+
+if __name__ == '__main__':
+    main()
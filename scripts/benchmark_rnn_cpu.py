@@ -0,0 +1,64 @@
+"""
+report how many sequences per second the RNN trains on, and evaluates perplexity on, for each rnn_type on CPU.
+
+sequences are random, and about as long as the sentences in the corpus.
+the number of intra-op threads can be set with TRAINDSMS_NUM_THREADS.
+"""
+
+import time
+import numpy as np
+import torch
+
+from traindsms.dsms.device import set_num_cpu_threads
+from traindsms.dsms.rnn import RNN, BatchStore
+from traindsms.params import RNNParams
+
+NUM_SEQUENCES = 20_000
+VOCAB_SIZE = 100
+SEQ_LENGTHS = [5, 6, 7]
+
+
+def main():
+    set_num_cpu_threads()
+    rng = np.random.default_rng(0)
+    token2id = {f'w{i}': i for i in range(VOCAB_SIZE)}
+    seq_num = [rng.integers(0, VOCAB_SIZE, size=rng.choice(SEQ_LENGTHS)).tolist() for _ in range(NUM_SEQUENCES)]
+
+    for rnn_type in ['srn', 'lstm']:
+        params = RNNParams(rnn_type=rnn_type,
+                           embed_size=64,
+                           num_layers=2,
+                           train_percent=1.0,
+                           embed_init_range=0.05,
+                           dropout_prob=0.0,
+                           batch_size=64,
+                           num_epochs=1,
+                           learning_rate=0.06,
+                           grad_clip=1.0,
+                           lr_decay=0.001,
+                           weight_decay=0.0,
+                           embeddings_location='wx',
+                           device='cpu',
+                           )
+        dsm = RNN(params, token2id, seq_num)
+        dsm.model.to(dsm.device, dtype=torch.float32)
+        dsm.criterion = torch.nn.CrossEntropyLoss()
+        dsm.optimizer = torch.optim.Adagrad(dsm.model.parameters(), lr=params.learning_rate)
+        batch_store = BatchStore(seq_num, dsm.device)
+
+        start = time.perf_counter()
+        dsm.train_epoch(batch_store)
+        time_train = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dsm.calc_pp(batch_store, verbose=False)
+        time_eval = time.perf_counter() - start
+
+        print(f'rnn_type={rnn_type:<4} '
+              f'threads={torch.get_num_threads()} '
+              f'train={NUM_SEQUENCES / time_train:>10,.0f} sequences/s '
+              f'perplexity={NUM_SEQUENCES / time_eval:>10,.0f} sequences/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""
+compare time and peak memory of the SVD backends available to count models.
+
+a random sparse matrix with the shape of a concatenated word-by-word matrix is reduced by each backend,
+and the agreement of the resulting subspace with the exact SVD is reported.
+
+peak memory only includes allocations made by numpy and python, not workspace allocated by LAPACK or ARPACK.
+"""
+
+import numpy as np
+from scipy import sparse
+
+from traindsms.dsms import count
+from traindsms.dsms.count import reduce
+
+VOCAB_SIZE = 2_000
+DENSITY = 0.05
+REDUCE_SIZE = 30
+
+count.TRACE_MEMORY = True
+
+input_matrix = sparse.random(VOCAB_SIZE, 2 * VOCAB_SIZE, density=DENSITY, format='csr', random_state=0)
+
+u_exact = reduce(input_matrix.toarray(), 'svd', REDUCE_SIZE)
+for reduce_type in ['svd', 'tsvd', 'rsvd']:
+    u = reduce(input_matrix, reduce_type, REDUCE_SIZE)
+    # cosines of principal angles between subspaces are 1 if subspaces are identical
+    agreement = np.linalg.svd(u_exact.T @ u, compute_uv=False).mean()
+    print(f'reduce_type={reduce_type:<6} agreement with exact SVD={agreement:.4f}')
+    print()
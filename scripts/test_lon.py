@@ -1,5 +1,4 @@
-import math
-import networkx as nx
+import numpy as np
 import time
 
 from missingadjunct.corpus import Corpus
@@ -11,9 +10,8 @@ from traindsms.params import LONParams
 
 def main():
     """
-    This is an attempt to get access to activation-spreading distance for all paths.
-    It failed as number of possible paths
-    could be very large basing on the graph structure, and time complexity could be exponential
+    get the activation-spreading distance between all pairs of nodes, summed over all walks of up to 2 * diameter - 1
+    edges. walks are counted by dynamic programming, rather than by enumerating every path, which is exponential.
     """
 
     corpus = Corpus(include_location=False,
@@ -31,19 +29,13 @@ def main():
     dsm = LON(params, sentences)
     dsm.train()
 
-    diameter = nx.algorithms.distance_measures.diameter(dsm.undirected_network)
-    print(diameter)
+    print(f'diameter={dsm.diameter}')
 
-    for node in dsm.node_list:
-        start_time = time.time()
-        dsm.get_path_distance(node, 1, [])
-        end_time = time.time()
-        time_getting_paths = end_time - start_time
-        print()
-        print('{} used to get paths from {}'.format(time_getting_paths, node))
-        print()
-        node_paths = dsm.path_distance_dict[node]
-        for target_node in node_paths:
-            print(node, target_node)
-            print(node_paths[target_node])
+    start_time = time.time()
+    walk_activation = dsm.get_walk_activation()
+    print(f'{time.time() - start_time:.2f}s used to get activations over all walks between {len(dsm.node_list):,} nodes')
 
+    for node, activations in zip(dsm.node_list, walk_activation):
+        print()
+        for target_id in np.argsort(activations)[::-1][:10]:
+            print(node, dsm.node_list[target_id], activations[target_id])
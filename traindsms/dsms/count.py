@@ -1,14 +1,26 @@
+import hashlib
+import itertools
+import os
 import numpy as np
-from cytoolz import itertoolz
 import pyprind
 import sys
 import time
-from typing import List, Tuple
-
+import tracemalloc
+from pathlib import Path
+from scipy import sparse
+from scipy.sparse import linalg as slinalg
+from sklearn.utils.extmath import randomized_svd
+from typing import List, Optional, Tuple, Union
+
+from traindsms.config import Dirs
 from traindsms.params import CountParams
 
-PAD = '*PAD*'
 VERBOSE = False
+CACHE_SVD = False  # cache SVD reductions on disk. only re-runs of the same job hit it (corpus is seeded by job name)
+SEED = 0  # for randomized and truncated (ARPACK) SVD, so that reductions are reproducible
+TRACE_MEMORY = False  # report peak memory of reductions, for benchmarking only (slow, requires python >= 3.9)
+
+Matrix = Union[np.ndarray, sparse.csr_matrix]  # count, normalized and reduced matrices may be dense or sparse
 
 
 class CountDSM:
@@ -24,77 +36,81 @@ class CountDSM:
 
         self.t2e = None
 
+    def get_token_and_doc_ids(self) -> Tuple[np.array, np.array]:
+        """
+        return token IDs of all sequences in a single array, and the index of the sequence each token came from
+        """
+        doc_lengths = np.array([len(token_ids) for token_ids in self.seq_num], int)
+        token_ids = np.fromiter(itertools.chain.from_iterable(self.seq_num), int, count=doc_lengths.sum())
+        doc_ids = np.repeat(np.arange(len(self.seq_num)), doc_lengths)
+        return token_ids, doc_ids
+
     # ////////////////////////////////////////////////// word-by-word
 
-    def create_ww_matrix_fast(self):  # no function call overhead - twice as fast
+    def create_ww_matrix_fast(self) -> sparse.csr_matrix:  # no python loop over windows
         window_type = self.params.count_type[1]
         window_size = self.params.count_type[2]
         window_weight = self.params.count_type[3]
 
         print('Counting word-word co-occurrences in {}-word moving window'.format(window_size))
 
-        # count
+        # co-occurrences are never counted across sequence boundaries, so no padding is needed.
         num_docs = len(self.seq_num)
-        pbar = pyprind.ProgBar(num_docs, stream=sys.stdout)
-        count_matrix = np.zeros([self.vocab_size, self.vocab_size], int)
-        for token_ids in self.seq_num:
-            token_ids += [PAD] * window_size  # add padding such that all co-occurrences in last window are captured
-
-            if VERBOSE:
-                print(token_ids)
-
-            for w in itertoolz.sliding_window(window_size + 1, token_ids):  # + 1 because window consists of t2s only
-
-                if VERBOSE:
-                    print([self.vocab[i] if isinstance(i, int) else PAD for i in w])
-
-                # in a window, we count all co-occurrences between first token and all others.
-                # a co-occurrence is between a t1_id and a t2_id, each corresponds to the ID of a token in the vocab.
-
-                t1_id = w[0]
-                for dist, t2_id in enumerate(w[1:]):
+        token_ids, doc_ids = self.get_token_and_doc_ids()
+
+        # collect (t1, t2, dist) offsets: a t2 at distance dist + 1 to the right of t1 in the same sequence
+        t1_ids = []
+        t2_ids = []
+        weights = []
+        for dist in range(window_size):
+            offset = dist + 1
+            is_same_doc = doc_ids[:-offset] == doc_ids[offset:]
+            t1_ids.append(token_ids[:-offset][is_same_doc])
+            t2_ids.append(token_ids[offset:][is_same_doc])
+            if window_weight == "linear":
+                weights.append(np.full(is_same_doc.sum(), window_size - dist, int))
+            elif window_weight == "flat":
+                weights.append(np.ones(is_same_doc.sum(), int))
+            else:
+                raise AttributeError('Invalid arg to "window_weight".')
+        t1_ids = np.concatenate(t1_ids)
+        t2_ids = np.concatenate(t2_ids)
+        weights = np.concatenate(weights)
 
-                    # increment
-                    if t1_id == PAD or t2_id == PAD:
-                        continue
-                    if window_weight == "linear":
-                        count_matrix[t1_id, t2_id] += window_size - dist
-                    elif window_weight == "flat":
-                        count_matrix[t1_id, t2_id] += 1
-                    if VERBOSE:
-                        print('row {:>3} col {:>3} set to {}'.format(t1_id, t2_id, count_matrix[t1_id, t2_id]))
+        if VERBOSE:
+            print(f'Collected {len(weights):,} co-occurrences from {num_docs:,} sequences')
 
-            if VERBOSE:
-                print()
-            pbar.update()
+        # count - accumulate all weighted co-occurrences in one pass (duplicate entries are summed)
+        count_matrix = sparse.coo_matrix((weights, (t1_ids, t2_ids)),
+                                         shape=(self.vocab_size, self.vocab_size),
+                                         dtype=int).tocsr()
 
         # window_type
         if window_type == 'forward':
             final_matrix = count_matrix
         elif window_type == 'backward':
-            final_matrix = count_matrix.transpose()
+            final_matrix = count_matrix.transpose().tocsr()
         elif window_type == 'summed':
-            final_matrix = count_matrix + count_matrix.transpose()
+            final_matrix = (count_matrix + count_matrix.transpose()).tocsr()
         elif window_type == 'concatenated':
-            final_matrix = np.concatenate((count_matrix, count_matrix.transpose()), axis=1)
+            final_matrix = sparse.hstack((count_matrix, count_matrix.transpose()), format='csr')
         else:
             raise AttributeError('Invalid arg to "window_type".')
 
-        print('Shape of normalized matrix={}'.format(final_matrix.shape))
+        print('Shape of count matrix={} with {:,} non-zero entries'.format(final_matrix.shape, final_matrix.nnz))
 
         return final_matrix
 
     # ////////////////////////////////////////////////// word-by-document
 
-    def create_wd_matrix(self):
+    def create_wd_matrix(self) -> sparse.csr_matrix:
         num_docs = len(self.seq_num)
-        pbar = pyprind.ProgBar(num_docs, stream=sys.stdout)
-        count_matrix = np.zeros([self.vocab_size, num_docs], int)
         print('\nCounting word occurrences in {} documents'.format(num_docs))
-        for i in range(num_docs):
-            for j in self.seq_num[i]:
-                count_matrix[j, i] += 1
-            pbar.update()
+        token_ids, doc_ids = self.get_token_and_doc_ids()
+        count_matrix = sparse.coo_matrix((np.ones_like(token_ids), (token_ids, doc_ids)),
+                                         shape=(self.vocab_size, num_docs),
+                                         dtype=int).tocsr()
+        print('Shape of count matrix={} with {:,} non-zero entries'.format(count_matrix.shape, count_matrix.nnz))
         return count_matrix
 
     # ////////////////////////////////////////////////// train
@@ -113,21 +129,46 @@ class CountDSM:
 
         # normalize + reduce
         norm_matrix = normalize(count_matrix, self.params.norm_type)
-        reduced_matrix = reduce(norm_matrix, self.params.reduce_type[0], self.params.reduce_type[1])
+        if self.params.reduce_type[0] == 'svd' and CACHE_SVD:
+            svd_cache_path = Dirs.runs / 'svd_cache' / f'{self.make_svd_cache_key()}.npz'
+        else:
+            svd_cache_path = None
+        reduced_matrix = reduce(norm_matrix, self.params.reduce_type[0], self.params.reduce_type[1], svd_cache_path)
+        if sparse.issparse(reduced_matrix):  # embeddings must be dense
+            reduced_matrix = reduced_matrix.toarray()
 
         self.t2e = {t: e for t, e in zip(self.vocab, reduced_matrix)}
 
         return reduced_matrix  # for unittest
 
+    # ////////////////////////////////////////////////// svd cache
+
+    def make_svd_cache_key(self) -> str:
+        """
+        return a key that uniquely identifies the normalized count matrix.
+
+        Note:
+            the corpus is identified by its token sequences rather than by corpus params alone,
+            because the corpus also depends on the seed (job name) used to sample it.
+            as a consequence, the cache is only hit by jobs with the same job name (e.g. re-runs of a job),
+            and not by different replications of the same params.
+        """
+        token_ids, doc_ids = self.get_token_and_doc_ids()
+        h = hashlib.sha1()
+        h.update(repr((tuple(self.params.count_type), self.params.norm_type, tuple(self.vocab))).encode())
+        h.update(token_ids.tobytes())
+        h.update(doc_ids.tobytes())
+        return h.hexdigest()
+
     def get_performance(self):
         return {}
 
 # ////////////////////////////////////////////////// normalizations
 
 
-def normalize(input_matrix: np.array,
+def normalize(input_matrix: Matrix,
               norm_type: str,
-              ) -> np.array:
+              ) -> Matrix:
     if norm_type == 'row_sum':
         norm_matrix = norm_rowsum(input_matrix)
     elif norm_type == 'col_sum':
@@ -146,150 +187,355 @@ def normalize(input_matrix: np.array,
     return norm_matrix
 
 
-def norm_rowsum(input_matrix: np.array,
-                ) -> np.array:
+def _divide_by_sums(input_matrix: np.array,
+                    axis: int,
+                    name: str,
+                    ) -> np.array:
+    """divide each row (axis=1) or column (axis=0) by its sum, leaving rows or columns with zero sum at 0"""
+    sums = input_matrix.sum(axis, keepdims=True)
+    for i in np.flatnonzero(sums == 0):
+        print('    Warning: {} {} had sum of zero. Setting prob to 0'.format(name, i))
+    return np.divide(input_matrix, sums, out=np.zeros_like(input_matrix, float), where=sums != 0)
+
+
+def norm_rowsum(input_matrix: Matrix,
+                ) -> Matrix:
     print('Normalizing matrix by row sums')
 
-    num_rows = input_matrix.shape[0]
-    res = np.zeros_like(input_matrix, float)
-    for i in range(num_rows):
-        if input_matrix[i, :].sum() == 0:
-            print('    Warning: Row {} had sum of zero. Setting prob to 0'.format(i))
-        else:
-            res[i, :] = input_matrix[i, :] / input_matrix[i, :].sum()
-    return res
+    if sparse.issparse(input_matrix):
+        return _norm_rowsum_sparse(input_matrix)
 
+    return _divide_by_sums(input_matrix, axis=1, name='Row')
 
-def norm_col_sum(input_matrix: np.array,
-                 ) -> np.array:
+
+def norm_col_sum(input_matrix: Matrix,
+                 ) -> Matrix:
     print('Normalizing matrix by column sums')
 
-    num_cols = input_matrix.shape[1]
-    res = np.zeros_like(input_matrix, float)
-    for i in range(num_cols):
-        if input_matrix[:, i].sum() == 0:
-            print('    Warning: Column {} had sum of zero. Setting prob to 0'.format(i))
-        else:
-            res[:, i] = input_matrix[:, i] / input_matrix[:, i].sum()
-    return res
+    if sparse.issparse(input_matrix):
+        return _norm_rowsum_sparse(input_matrix.transpose(), name='Column').transpose().tocsr()
 
+    return _divide_by_sums(input_matrix, axis=0, name='Column')
 
-def norm_tfidf(input_matrix: np.array,
-               ) -> np.array:
+
+def norm_tfidf(input_matrix: Matrix,
+               ) -> Matrix:
     print('Normalizing matrix by tf-idf')
-    
-    num_rows = input_matrix.shape[0]
-    num_cols = nd = input_matrix.shape[1]
-
-    res = np.zeros_like(input_matrix, float)
-    for i in range(num_rows):
-        df = np.count_nonzero(input_matrix[i, :])  # num documents/columns in which word (in row) occurs
-        idf = np.log((nd + 1) / (df + 1)) + 1
-        for j in range(num_cols):
-            tf = np.log(1 + res[i, j])
-            res[i, j] = tf * idf
-    return res
+
+    if sparse.issparse(input_matrix):
+        return _norm_tfidf_sparse(input_matrix)
+
+    nd = input_matrix.shape[1]
+    df = np.count_nonzero(input_matrix, axis=1)  # num documents/columns in which word (in row) occurs
+    idf = np.log((nd + 1) / (df + 1)) + 1
+    tf = np.log(1 + input_matrix)
+    return tf * idf[:, np.newaxis]
 
 
-def norm_ppmi(input_matrix: np.array,
-              ) -> np.array:
+def norm_ppmi(input_matrix: Matrix,
+              ) -> Matrix:
     print('Normalizing matrix by ppmi')
 
-    num_rows = input_matrix.shape[0]
-    num_cols = input_matrix.shape[1]
+    if sparse.issparse(input_matrix):
+        return _norm_ppmi_sparse(input_matrix)
 
     row_sums = input_matrix.sum(1)
     col_sums = input_matrix.sum(0)
     matrix_sum = row_sums.sum()
 
-    res = np.zeros_like(input_matrix, float)
-    for i in range(num_rows):
-        for j in range(num_cols):
-            if input_matrix[i, j] == 0:
-                res[i, j] = 0
-            elif (row_sums[i] == 0) or (col_sums[j] == 0):
-                res[i, j] = 0
-            else:
-                top = input_matrix[i, j] / matrix_sum
-                bottom = (row_sums[i] / matrix_sum) * (col_sums[j] / matrix_sum)
-                div = top/bottom
-                if div <= 1:
-                    res[i, j] = 0
-                else:
-                    res[i, j] = np.log(div)
-    return res
+    # cells that are zero, or whose row or column sums to zero, are left at 0
+    is_defined = (input_matrix != 0) & (row_sums != 0)[:, np.newaxis] & (col_sums != 0)[np.newaxis, :]
 
+    top = input_matrix / matrix_sum
+    bottom = np.outer(row_sums / matrix_sum, col_sums / matrix_sum)
+    div = np.divide(top, bottom, out=np.ones_like(top, float), where=is_defined)
+    return np.log(np.maximum(div, 1))  # log(1) = 0 where div <= 1
 
-def row_log_entropy(input_matrix: np.array,
-                    ) -> np.array:
+
+def row_log_entropy(input_matrix: Matrix,
+                    ) -> Matrix:
     print('Normalizing matrix by log entropy')
 
-    num_rows = input_matrix.shape[0]
-    res = np.zeros_like(input_matrix, float)
+    if sparse.issparse(input_matrix):
+        return _row_log_entropy_sparse(input_matrix)
 
-    # row probabilities
-    row_prob_matrix = np.zeros_like(input_matrix, float)
-    for i in range(num_rows):
-        row_sum = input_matrix[i, :].sum()
-        if row_sum == 0:
-            print(f'Warning: Row {i} had sum of zero. Setting prob to 0')
-        else:
-            row_prob_matrix[i, :] = input_matrix[i, :] / row_sum
+    row_prob_matrix = _divide_by_sums(input_matrix, axis=1, name='Row')
+
+    # entropy = sigma[p(x) * log(1/p(x))]
+    row_entropy = np.sum(row_prob_matrix * np.log(1 / (1 + row_prob_matrix)), axis=1)
 
     log_frequencies = np.log(input_matrix + 1)
-    for i in range(num_rows):
-        # entropy = sigma[p(x) * log(1/p(x))]
-        row_entropy = np.dot(row_prob_matrix[i, :],
-                             np.log(1 / (1 + row_prob_matrix[i, :]))
-                             )
-        res[i, :] = log_frequencies[i, :] * row_entropy
+    return log_frequencies * row_entropy[:, np.newaxis]
+
+# ////////////////////////////////////////////////// sparse normalizations
+
+# these operate on the non-zero entries of a CSR matrix only.
+# all normalizations map zero to zero, so the result has the same sparsity structure as the input.
 
+
+def _to_csr_float(input_matrix: sparse.spmatrix,
+                  ) -> sparse.csr_matrix:
+    res = sparse.csr_matrix(input_matrix, dtype=float, copy=True)
+    res.eliminate_zeros()
+    return res
+
+
+def _get_row_ids(csr_matrix: sparse.csr_matrix,
+                 ) -> np.array:
+    """return the row index of each stored entry in a CSR matrix"""
+    return np.repeat(np.arange(csr_matrix.shape[0]), np.diff(csr_matrix.indptr))
+
+
+def _norm_rowsum_sparse(input_matrix: sparse.spmatrix,
+                        name: str = 'Row',
+                        ) -> sparse.csr_matrix:
+    res = _to_csr_float(input_matrix)
+    row_sums = np.asarray(res.sum(1)).ravel()
+    for i in np.flatnonzero(row_sums == 0):
+        print('    Warning: {} {} had sum of zero. Setting prob to 0'.format(name, i))
+    res.data /= row_sums[_get_row_ids(res)]
+    return res
+
+
+def _norm_tfidf_sparse(input_matrix: sparse.spmatrix,
+                       ) -> sparse.csr_matrix:
+    res = _to_csr_float(input_matrix)
+    nd = res.shape[1]
+    df = np.diff(res.indptr)  # num documents/columns in which word (in row) occurs
+    idf = np.log((nd + 1) / (df + 1)) + 1
+    tf = np.log(1 + res.data)
+    res.data = tf * idf[_get_row_ids(res)]
+    return res
+
+
+def _norm_ppmi_sparse(input_matrix: sparse.spmatrix,
+                      ) -> sparse.csr_matrix:
+    res = _to_csr_float(input_matrix)
+    row_sums = np.asarray(res.sum(1)).ravel()
+    col_sums = np.asarray(res.sum(0)).ravel()
+    matrix_sum = row_sums.sum()
+
+    top = res.data / matrix_sum
+    bottom = (row_sums[_get_row_ids(res)] / matrix_sum) * (col_sums[res.indices] / matrix_sum)
+    div = top / bottom
+    res.data = np.log(np.maximum(div, 1))  # log(1) = 0 where div <= 1
+    res.eliminate_zeros()
+    return res
+
+
+def _row_log_entropy_sparse(input_matrix: sparse.spmatrix,
+                            ) -> sparse.csr_matrix:
+    res = _to_csr_float(input_matrix)
+    row_ids = _get_row_ids(res)
+    row_sums = np.asarray(res.sum(1)).ravel()
+    for i in np.flatnonzero(row_sums == 0):
+        print('    Warning: Row {} had sum of zero. Setting prob to 0'.format(i))
+
+    # entropy = sigma[p(x) * log(1/p(x))]
+    row_probs = res.data / row_sums[row_ids]
+    row_entropy = np.bincount(row_ids,
+                              weights=row_probs * np.log(1 / (1 + row_probs)),
+                              minlength=res.shape[0])
+    res.data = np.log(res.data + 1) * row_entropy[row_ids]
     return res
 
 # ////////////////////////////////////////////////// reductions
 
 
-def reduce(input_matrix: np.array,
+def reduce(input_matrix: Matrix,
            reduce_type: str,
            reduce_size: int,
-           ) -> np.array:
+           svd_cache_path: Optional[Path] = None,
+           ) -> Matrix:
+    """
+    reduce the number of columns of input_matrix to reduce_size.
+    if svd_cache_path is given, an SVD reduction is read from (or written to) a cache on disk.
+
+    Note:
+        the time of each reduction is reported.
+        if TRACE_MEMORY, so is its peak memory, but only of allocations made by numpy and python:
+        workspace allocated by LAPACK and ARPACK is not traced, so the true peak is higher.
+    """
+    is_tracing = tracemalloc.is_tracing()
+    if TRACE_MEMORY:
+        if not is_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    start = time.time()
+
     if reduce_type == 'svd':
-        reduced_matrix = reduce_svd(input_matrix, reduce_size)
+        reduced_matrix = reduce_svd(input_matrix, reduce_size, svd_cache_path)
+    elif reduce_type == 'rsvd':
+        reduced_matrix = reduce_rsvd(input_matrix, reduce_size)
+    elif reduce_type == 'tsvd':
+        reduced_matrix = reduce_tsvd(input_matrix, reduce_size)
     elif reduce_type == 'rva':
         reduced_matrix = reduce_rva(input_matrix, reduce_size)
+    elif reduce_type == 'srva':
+        reduced_matrix = reduce_rva(input_matrix, reduce_size, projection='achlioptas')
     elif reduce_type is None:
         reduced_matrix = input_matrix
     else:
         raise AttributeError(f"Improper matrix reduction type '{reduce_type}'. "
-                             "Must be 'svd', 'rva', or None")
+                             "Must be 'svd', 'rsvd', 'tsvd', 'rva', 'srva', or None")
+
+    print(f'Completed reduction with reduce_type={reduce_type} in {time.time() - start:.2f} secs', flush=True)
+    if TRACE_MEMORY:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        if not is_tracing:
+            tracemalloc.stop()
+        print(f'Peak memory of reduction (excluding LAPACK/ARPACK workspace)={peak_memory / 1e6:,.1f} MB', flush=True)
+
     return reduced_matrix
 
 
-def reduce_svd(input_matrix: np.array,
+def reduce_svd(input_matrix: Matrix,
                reduce_size: int,
+               cache_path: Optional[Path] = None,
                ) -> np.array:
     print('Reducing matrix using SVD to {} singular values'.format(reduce_size))
-    u, s, v = np.linalg.svd(input_matrix)
-    # sparse_cooc_mat = sparse.csr_matrix(input_matrix).asfptype()
-    # u, s, v = slinalg.svds(cooc_mat, k=reduce_size)
+
+    if cache_path is None:
+        u, s = compute_svd(input_matrix, reduce_size)
+    else:
+        u, s = load_or_compute_svd(input_matrix, reduce_size, cache_path)
 
     reduced_matrix = u[:, 0:reduce_size]
     return reduced_matrix
 
 
-def reduce_rva(input_matrix: np.array,
+def compute_svd(input_matrix: Matrix,
+                reduce_size: int,
+                ) -> Tuple[np.array, np.array]:
+    """
+    return the first reduce_size left singular vectors and singular values, in order of decreasing singular value.
+    """
+    # truncated SVD only computes the requested number of singular vectors, but requires reduce_size < min(shape)
+    if sparse.issparse(input_matrix) and reduce_size < min(input_matrix.shape):
+        return _svds(input_matrix, reduce_size)
+
+    if sparse.issparse(input_matrix):
+        input_matrix = input_matrix.toarray()
+    u, s, v = np.linalg.svd(input_matrix, full_matrices=False)  # the full v is never needed
+
+    return u[:, 0:reduce_size], s[0:reduce_size]
+
+
+def _svds(input_matrix: Matrix,
+          reduce_size: int,
+          seed: int = SEED,
+          ) -> Tuple[np.array, np.array]:
+    v0 = np.random.RandomState(seed).uniform(-1, 1, min(input_matrix.shape))  # fixed starting vector
+    u, s, v = slinalg.svds(input_matrix.astype(float), k=reduce_size, v0=v0)
+    order = np.argsort(s)[::-1]  # svds returns singular values in ascending order
+    return u[:, order], s[order]
+
+
+def reduce_tsvd(input_matrix: Matrix,
+                reduce_size: int,
+                seed: int = SEED,
+                ) -> np.array:
+    """
+    truncated SVD using ARPACK. only reduce_size singular vectors are computed.
+    """
+    print('Reducing matrix using truncated SVD to {} singular values'.format(reduce_size))
+
+    if reduce_size >= min(input_matrix.shape):
+        raise ValueError('Truncated SVD requires reduce_size to be smaller than the number of rows and columns.')
+
+    u, s = _svds(input_matrix, reduce_size, seed)
+
+    return u
+
+
+def reduce_rsvd(input_matrix: Matrix,
+                reduce_size: int,
+                seed: int = SEED,
+                ) -> np.array:
+    """
+    randomized SVD (Halko et al., 2009). only reduce_size singular vectors are computed.
+    """
+    print('Reducing matrix using randomized SVD to {} singular values'.format(reduce_size))
+
+    u, s, v = randomized_svd(input_matrix.astype(float), n_components=reduce_size, random_state=seed)
+
+    return u
+
+
+def load_or_compute_svd(input_matrix: Matrix,
+                        reduce_size: int,
+                        cache_path: Path,
+                        ) -> Tuple[np.array, np.array]:
+    """
+    return the first reduce_size left singular vectors and singular values, computing them only if not on disk.
+
+    the cached decomposition is truncated to the largest reduce_size requested so far:
+    a smaller reduce_size is a slice of it, and a larger one replaces it.
+    because ARPACK results depend on the number of singular values requested,
+    a slice may differ slightly (in the last digits, or in sign) from a decomposition computed for reduce_size alone.
+    sparse input is never converted to a dense matrix, unless reduce_size is not smaller than its shape.
+    """
+    num_components = min(reduce_size, *input_matrix.shape)
+    if cache_path.exists():
+        with np.load(cache_path) as npz_file:
+            u, s = npz_file['u'], npz_file['s']
+        if u.shape[1] >= num_components:
+            print(f'Loaded SVD from {cache_path}')
+            return u[:, 0:reduce_size], s[0:reduce_size]
+        print(f'Cached SVD has only {u.shape[1]} singular values')
+
+    print(f'Computing SVD of matrix with shape={input_matrix.shape} to {reduce_size} singular values')
+    u, s = compute_svd(input_matrix, reduce_size)
+
+    # write to temporary file first, so that concurrent jobs never read a partially written file
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f'{cache_path.stem}_{os.getpid()}.tmp.npz')
+    np.savez(tmp_path, u=u, s=s)
+    os.replace(tmp_path, cache_path)
+    print(f'Saved SVD to {cache_path}')
+
+    return u, s
+
+
+def reduce_rva(input_matrix: Matrix,
                reduce_size,
                mean: float = 0.0,
                std_dev: float = 1.0,
+               projection: str = 'normal',
+               dtype: type = np.float64,
+               seed: Optional[int] = None,
+               block_size: int = 4096,
                ) -> np.array:
-    print('Reducing matrix using RVA')
-    num_rows = input_matrix.shape[0]
-    random_vectors = np.random.normal(mean, std_dev, [num_rows, reduce_size])
-    rva_matrix = np.zeros([num_rows, reduce_size], float)
-    pbar = pyprind.ProgBar(num_rows, stream=sys.stdout)
-    for i in range(num_rows):
-        for j in range(num_rows):
-            rva_matrix[i, :] += (input_matrix[i, j]*random_vectors[j, :])
+    """
+    random vector accumulation: each row is the sum of the random vectors of its columns, weighted by the row.
+    this is a single matrix product between input_matrix and a [num_cols, reduce_size] random projection,
+    computed in blocks of rows to limit the memory needed for casting the input to dtype.
+
+    projection:
+        'normal': dense projection with entries drawn from a normal distribution
+        'achlioptas': sparse projection with entries sqrt(3) * std_dev * (+1, 0, -1) with prob (1/6, 2/3, 1/6)
+
+    by default (seed=None), random vectors are drawn from numpy's global random state, so that replications differ.
+    """
+    print('Reducing matrix using RVA with {} projection'.format(projection))
+    num_rows, num_cols = input_matrix.shape
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    if projection == 'normal':
+        random_vectors = rng.normal(mean, std_dev, [num_cols, reduce_size]).astype(dtype)
+    elif projection == 'achlioptas':
+        signs = rng.choice([1, 0, -1], size=[num_cols, reduce_size], p=[1 / 6, 2 / 3, 1 / 6])
+        random_vectors = sparse.csr_matrix(signs * np.sqrt(3) * std_dev, dtype=dtype)
+    else:
+        raise AttributeError(f'Invalid arg to "projection" "{projection}".')
+
+    rva_matrix = np.zeros([num_rows, reduce_size], dtype)
+    num_blocks = int(np.ceil(num_rows / block_size))
+    pbar = pyprind.ProgBar(num_blocks, stream=sys.stdout)
+    for start in range(0, num_rows, block_size):
+        product = input_matrix[start:start + block_size].astype(dtype) @ random_vectors
+        if sparse.issparse(product):
+            product = product.toarray()
+        rva_matrix[start:start + block_size] = product
         pbar.update()
 
     return rva_matrix
@@ -1,11 +1,13 @@
 import math
 import time
-import networkx as nx
 import numpy as np
-from typing import List, Dict, Tuple
-from collections import defaultdict
+from typing import List, Dict, Tuple, Any
+from collections import Counter
+from scipy.sparse import csr_matrix
+from cached_property import cached_property
 
 from traindsms.params import CTNParams
+from traindsms.dsms.graph import CSRGraph
 from traindsms.dsms.network import NetworkBaseClass
 
 
@@ -31,8 +33,10 @@ class CTN(NetworkBaseClass):
         self.num_vocab = len(token2id)
         self.seq_parsed = seq_parsed
 
-        self.diamond_list = []
-        self.lexical_network = None
+        self.constituents = []  # constituent table: the constituent with ID i
+        self.constituent2token_id = None  # token ID of each constituent that is a word, else -1
+        self.diamond_list = []  # for each sentence: edges and node IDs (the last is the whole sentence)
+        self.lexical_matrix = None  # normalized weights between words, the lexical network is built from it
 
     def extract_edges_and_nodes(self, x):
         """
@@ -73,50 +77,80 @@ class CTN(NetworkBaseClass):
         nodes.append(x)
         return edges, nodes
 
+    def intern_constituent(self,
+                           x,
+                           key2id: Dict[Any, int],
+                           edges: List[Tuple[int, int]],
+                           node_ids: List[int],
+                           ) -> int:
+        """
+        return the integer ID of a constituent, adding it (and its sub-constituents) to the constituent table if new.
+        edges (sub-constituent ID, constituent ID) and IDs of all sub-constituents are collected along the way.
+
+        Note:
+            a constituent is identified by the tuple of IDs of its sub-constituents,
+            so that a nested tuple is never hashed as a whole.
+        """
+        if type(x) == str:
+            key = x
+        else:
+            child_ids = [self.intern_constituent(item, key2id, edges, node_ids) for item in x]
+            key = tuple(child_ids)
+            for child_id in child_ids:
+                edges.append((child_id, -1))  # the ID of the parent is not known yet
+                node_ids.append(child_id)
+
+        try:
+            constituent_id = key2id[key]
+        except KeyError:
+            constituent_id = len(self.constituents)
+            key2id[key] = constituent_id
+            self.constituents.append(tuple(x) if type(x) == list else x)
+
+        # fill in the parent of the edges to the sub-constituents of x
+        if type(x) != str:
+            for n in range(len(edges) - len(x), len(edges)):
+                edges[n] = (edges[n][0], constituent_id)
+
+        return constituent_id
+
     def train(self) -> None:
         """
         create the network by joining the trees of the corpus.
         """
 
-        network_edges = []
-        network_nodes = []
-        for seq_parsed_i in self.seq_parsed:
-            edges, nodes = self.complete_tree(seq_parsed_i)
-
-            self.diamond_list.append((edges, nodes))
-            network_edges.extend(edges)
-            network_nodes.extend(nodes)
-
-        self.node_list = list(set(network_nodes))
-
-        network_edge_dict = {}
-        for edge in network_edges:
-            if edge in network_edge_dict:
-                network_edge_dict[edge] = network_edge_dict[edge] + 1
-            else:
-                network_edge_dict[edge] = 1
-
-        weighted_network_edge = []
-        for edge in network_edge_dict:
-            weighted_network_edge.append(edge + (math.log10(network_edge_dict[edge]+1),))
-
-        if VERBOSE:
-            print()
-            print('Weighted Edges:')
-            for edge in weighted_network_edge:
-                print(self.node_list.index(edge[0]), self.node_list.index(edge[1]), edge)
-            print()
+        start_time = time.time()
 
-        if VERBOSE:
-            print()
-            print('Nodes in the network:')
-            for node in self.node_list:
-                print(self.node_list.index(node), node)
+        # intern all constituents, and represent each sentence by the IDs of its edges and nodes.
+        # identical trees share a single entry in the constituent table, and the same ID arrays.
+        key2id = {}
+        root_id2tree_info = {}
+        for seq_parsed_i in self.seq_parsed:
+            edges = []
+            node_ids = []
+            root_id = self.intern_constituent(seq_parsed_i, key2id, edges, node_ids)
+            if root_id not in root_id2tree_info:
+                node_ids.append(root_id)
+                root_id2tree_info[root_id] = (np.array(edges, dtype=np.int32).reshape(-1, 2),
+                                              np.array(node_ids, dtype=np.int32))
+            self.diamond_list.append(root_id2tree_info[root_id])
+
+        # row i of the adjacency matrix is the constituent with ID i
+        self.node_list = self.constituents
+        self.constituent2token_id = np.array([self.token2id[c] if type(c) == str else -1 for c in self.constituents])
+
+        # weight edges (sub-constituent ID, constituent ID)
+        all_edges = np.concatenate([edges for edges, node_ids in self.diamond_list])
+        self.edge_ids, edge_counts = np.unique(all_edges, axis=0, return_counts=True)
+        self.edge_weights = np.log10(edge_counts + 1)
 
         # make network
-        self.network = nx.DiGraph()
-        self.network.add_weighted_edges_from(weighted_network_edge)
-        self.get_constituent_net()  # this populates self.lexical_network
+        self.network = CSRGraph(self.constituents, self.edge_ids, self.edge_weights, directed=True)
+        self.invalidate_caches()
+        self.get_constituent_net()  # this populates self.lexical_matrix
+
+        self.build_time = time.time() - start_time
+        self.print_summary()
 
     def get_neighbor_node(self, node):
         """
@@ -124,7 +158,7 @@ class CTN(NetworkBaseClass):
         where a 'neighborhood' refers to all the trees containing the given node.
         """
         neighborhood = [node]
-        if self.network.out_degree(node) == 0 or type(self.network.out_degree(node)) != int:
+        if node not in self.network or self.network.out_degree(node) == 0:
             neighborhood = set(neighborhood)
             return neighborhood
         else:
@@ -165,36 +199,76 @@ class CTN(NetworkBaseClass):
     # the weighted shortest path between them, where the weight of an edge is the constituent distances
     # between the word pairs linked by the edge.
 
+    def get_tree_word_weights(self,
+                              sent_edge: np.array,  # [num_edges, 2] IDs of sub-constituent and constituent
+                              sent_node: np.array,  # IDs of all nodes, the last is the whole sentence
+                              ) -> Tuple[np.array, np.array, np.array]:
+        """
+        for a single tree, return the contribution of each pair of different words to the weight matrix:
+        row IDs, column IDs, and weights .5 ** (distance in tree - 1).
+        """
+        token_ids = self.constituent2token_id[sent_node]
+        word_node_ids = sent_node[token_ids >= 0]
+        word_ids = token_ids[token_ids >= 0]
+        is_different = word_ids[:, np.newaxis] != word_ids[np.newaxis, :]
+        if not is_different.any():  # e.g. a tree that is just a word
+            return np.array([], int), np.array([], int), np.array([], float)
+
+        # if every constituent occurs only once, the sentence is a tree, and distances follow from depths and LCAs.
+        # otherwise, identical constituents are a single node, and distances must be computed on the graph.
+        if len(np.unique(sent_node)) == len(sent_node):
+            leaves, leaf_distances = get_leaf_distances(self.constituents[sent_node[-1]])
+            leaf2index = {leaf: i for i, leaf in enumerate(leaves)}
+            indices = [leaf2index[self.constituents[node_id]] for node_id in word_node_ids]
+            distances = leaf_distances[np.ix_(indices, indices)]
+        else:
+            tree_node_ids, tree_edge_ids = np.unique(sent_edge, return_inverse=True)
+            tree = CSRGraph(tree_node_ids.tolist(),
+                            tree_edge_ids.reshape(-1, 2),
+                            np.ones(len(sent_edge)),
+                            directed=False)
+            distances = tree.shortest_path_lengths(word_node_ids.tolist())
+            distances = distances[:, [tree.node2id[node_id] for node_id in word_node_ids.tolist()]]
+
+        row_ids, col_ids = np.nonzero(is_different)
+        weights = .5 ** (distances[row_ids, col_ids] - 1)
+        return word_ids[row_ids], word_ids[col_ids], weights
+
     def get_constituent_edge_weight(self):
 
-        weight_matrix = np.zeros((self.num_vocab, self.num_vocab), float)
         count_matrix = np.zeros((self.num_vocab, self.num_vocab), float)
 
         start_time = time.time()
-        count = 0
+
+        # the corpus repeats the same trees many times: compute the contribution of each unique tree only once.
+        # identical trees have the same root ID
+        tree2count = Counter()
+        tree2info = {}
         for tree_info in self.diamond_list:
-            sent_node = tree_info[1]
-            sent_edge = tree_info[0]
-            sent_words = []
-            tree = nx.Graph()
-            tree.add_edges_from(sent_edge)
-            for node in sent_node:
-                if type(node) == str:
-                    sent_words.append(node)
-
-            for word1 in sent_words:
-                for word2 in sent_words:
-                    id1 = self.token2id[word1]
-                    id2 = self.token2id[word2]
-                    if id1 != id2:
-                        weight_matrix[id1][id2] = weight_matrix[id1][id2] + .5 ** (
-                                nx.shortest_path_length(tree, word1, word2) - 1)
-                        # count_matrix[id1][id2] = count_matrix[id1][id2] + 1
-
-            count += 1
+            root_id = tree_info[1][-1]
+            tree2count[root_id] += 1
+            tree2info.setdefault(root_id, tree_info)
+
+        all_row_ids = [np.array([], int)]
+        all_col_ids = [np.array([], int)]
+        all_weights = [np.array([], float)]
+        for root_id, num_occurrences in tree2count.items():
+            sent_edge, sent_node = tree2info[root_id]
+            row_ids, col_ids, weights = self.get_tree_word_weights(sent_edge, sent_node)
+            all_row_ids.append(row_ids)
+            all_col_ids.append(col_ids)
+            all_weights.append(weights * num_occurrences)
+
+        # weights are powers of .5, so summing them in a different order than one tree at a time is exact
+        flat_ids = np.concatenate(all_row_ids) * self.num_vocab + np.concatenate(all_col_ids)
+        weight_matrix = np.bincount(flat_ids,
+                                    weights=np.concatenate(all_weights),
+                                    minlength=self.num_vocab * self.num_vocab,
+                                    ).reshape(self.num_vocab, self.num_vocab)
 
         if VERBOSE:
-            print(f'Added {count} weights to the weight matrix.')
+            print(f'Added weights of {len(tree2count)} unique trees ({len(self.diamond_list)} total) '
+                  f'to the weight matrix.')
             print(f'Built weight matrix in {time.time() - start_time} secs.')
 
         return weight_matrix, count_matrix
@@ -206,22 +280,29 @@ class CTN(NetworkBaseClass):
     # for constituent-net, 2 words are linked if and only if they co-appear in at least one constituent
 
     def get_constituent_net(self):
-        self.lexical_network = nx.Graph()
         weight_matrix, count_matrix = self.get_constituent_edge_weight()
 
         weight_normalizer = weight_matrix.sum(0)
         # count_normalizer = count_matrix.sum(0)
+        weight_normalizer[weight_normalizer == 0] = 1
 
-        for k in range(self.num_vocab):
-            if weight_normalizer[k] == 0:
-                # count_normalizer[k] = count_normalizer[k] + 1
-                weight_normalizer[k] = weight_normalizer[k] + 1
+        normalized_weights = weight_matrix / np.sqrt(np.outer(weight_normalizer, weight_normalizer))
+        self.lexical_matrix = csr_matrix(normalized_weights)
+
+    @cached_property
+    def lexical_network(self) -> CSRGraph:
+        """
+        graph view of the lexical network, built on demand:
+        2 words are linked if the normalized weight between them is larger than zero.
+        """
+        id2token = [None] * self.num_vocab
+        for token, i in self.token2id.items():
+            id2token[i] = token
+        return CSRGraph.from_weight_matrix(id2token, self.lexical_matrix, directed=False)  # the matrix is symmetric
 
-        for token_i, i in self.token2id.items():
-            for token_j, j in self.token2id.items():
-                w = weight_matrix[i][j] / (weight_normalizer[i] * weight_normalizer[j]) ** .5
-                if w > 0:
-                    self.lexical_network.add_edge(token_i, token_j)
+    def invalidate_caches(self) -> None:
+        NetworkBaseClass.invalidate_caches(self)
+        self.__dict__.pop('lexical_network', None)
 
     def compute_distance_matrix(self, word_list1, word_list2):  # TODO unused
         """
@@ -231,16 +312,14 @@ class CTN(NetworkBaseClass):
         l1 = len(word_list1)
         l2 = len(word_list2)
         distance_matrix = np.zeros((l1, l2), float)
+        word_ids2 = [self.lexical_network.node2id[word] for word in word_list2]
 
         count = 0
         epoch = 0
         for i in range(l1):
+            path_lengths = self.lexical_network.shortest_path_lengths([word_list1[i]])[0]  # np.inf if there is no path
             for j in range(l2):
-                pair = [word_list1[i], word_list2[j]]
-                if nx.has_path(self.lexical_network, pair[0], pair[1]):
-                    distance = nx.shortest_path_length(self.lexical_network, pair[0], pair[1])
-                else:
-                    distance = np.inf
+                distance = path_lengths[word_ids2[j]]
                 distance_matrix[i][j] = round(distance, 3)
 
                 count = count + 1
@@ -258,9 +337,11 @@ class CTN(NetworkBaseClass):
 
         # TODO unused
 
+        import networkx as nx  # graph edit distance is only implemented in networkx
+
         graph_list = []
         for word in word_list:
-            g = self.get_sized_neighbor(word, neighbor_size)
+            g = self.get_sized_neighbor(word, neighbor_size).to_networkx()
             graph_list.append(g)
             # print(word, g.nodes)
             # print()
@@ -277,14 +358,15 @@ class CTN(NetworkBaseClass):
 
         print(f'Computing relatedness between {verb + WS + theme:>22} and instruments...', flush=True)
 
-        if (verb, theme) in self.node_list:
-            sr_verb = self.activation_spreading_analysis(verb, self.node_list,
+        # activations are cached per (source, excluded edges) in NetworkBaseClass
+        if (verb, theme) in self.node2id:
+            sr_verb = self.activation_spreading_analysis(verb, instruments,
                                                          excluded_edges=[((verb, theme), theme)])
-            sr_theme = self.activation_spreading_analysis(theme, self.node_list,
+            sr_theme = self.activation_spreading_analysis(theme, instruments,
                                                           excluded_edges=[((verb, theme), verb)])
         else:
-            sr_verb = self.activation_spreading_analysis(verb, self.node_list, excluded_edges=[])
-            sr_theme = self.activation_spreading_analysis(theme, self.node_list, excluded_edges=[])
+            sr_verb = self.activation_spreading_analysis(verb, instruments, excluded_edges=[])
+            sr_theme = self.activation_spreading_analysis(theme, instruments, excluded_edges=[])
 
         scores = []
         for instrument in instruments:
@@ -295,10 +377,63 @@ class CTN(NetworkBaseClass):
 
         return scores
 
+    def get_verb_phrase_sources(self,
+                                verb_phrases: List[Tuple[str, str]],
+                                ) -> Tuple[List[Any], List[List[Tuple]]]:
+        """
+        the verb and the theme of each verb phrase are sources.
+        if the verb phrase is a constituent, activation from the verb must not pass through the edge to the theme,
+        and vice versa.
+        """
+        sources = []
+        excluded_edges_list = []
+        for verb, theme in verb_phrases:
+            sources.extend([verb, theme])
+            if (verb, theme) in self.node2id:
+                excluded_edges_list.extend([[((verb, theme), theme)], [((verb, theme), verb)]])
+            else:
+                excluded_edges_list.extend([[], []])
+        return sources, excluded_edges_list
+
     def get_performance(self):
         return {}
 
 
+def get_leaf_distances(tree) -> Tuple[List[str], np.array]:
+    """
+    for a nested tuple, return its leaves (words), and the number of edges between each pair of leaves.
+
+    the tree is walked once. the distance between 2 leaves is depth1 + depth2 - 2 * depth of their
+    lowest common ancestor, which is the length of the common prefix of their paths from the root, minus 1.
+    """
+    leaves = []
+    paths = []  # for each leaf, the IDs of all nodes from the root to the leaf
+    num_nodes = 0
+
+    def walk(node, path):
+        nonlocal num_nodes
+        path = path + [num_nodes]  # nodes are identified by position in the tree, not by value
+        num_nodes += 1
+        if type(node) == str:
+            leaves.append(node)
+            paths.append(path)
+        else:
+            for child in node:
+                walk(child, path)
+
+    walk(tree, [])
+
+    depths = np.array([len(path) - 1 for path in paths])
+    path_matrix = np.full((len(paths), depths.max() + 1), -1)
+    for i, path in enumerate(paths):
+        path_matrix[i, :len(path)] = path
+    is_shared = (path_matrix[:, np.newaxis, :] == path_matrix[np.newaxis, :, :]) & (path_matrix[:, np.newaxis, :] >= 0)
+    lca_depths = np.cumprod(is_shared, axis=2).sum(axis=2) - 1
+    distances = depths[:, np.newaxis] + depths[np.newaxis, :] - 2 * lca_depths
+
+    return leaves, distances
+
+
 def convert_to_tuple(iterable):
     """
     for a given nested list, return a copy in tuple data type
@@ -0,0 +1,46 @@
+"""
+choose the device on which the neural DSMs (RNN, Transformer) are trained and evaluated.
+"""
+import os
+import torch
+from typing import Optional
+
+DEVICE_ENV_NAME = 'TRAINDSMS_DEVICE'  # e.g. 'cpu', 'cuda', 'cuda:1'
+NUM_THREADS_ENV_NAME = 'TRAINDSMS_NUM_THREADS'
+
+
+def get_device(device: Optional[str] = None) -> torch.device:
+    """
+    return the device given in params, else the one given by the environment variable TRAINDSMS_DEVICE,
+    else cuda if it is available, and cpu otherwise.
+
+    Note:
+        this has no side effects. the number of cpu threads is set once per job, by set_num_cpu_threads().
+    """
+    if device is None:
+        device = os.environ.get(DEVICE_ENV_NAME)
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    res = torch.device(device)
+    print(f'Using device={res} with {torch.get_num_threads()} intra-op threads', flush=True)
+    return res
+
+
+def set_num_cpu_threads(num_threads: Optional[int] = None) -> None:
+    """
+    use one intra-op thread per logical cpu available to this process, unless given by TRAINDSMS_NUM_THREADS.
+    the models are tiny, so that threads beyond the cpus assigned to the job (e.g. on a shared worker node)
+    only add contention.
+    logical cpus include hyper-threads: to use one thread per physical core, set TRAINDSMS_NUM_THREADS.
+
+    this changes the setting for all torch code in the process, and should be called once, at the start of a job.
+    """
+    if num_threads is None:
+        num_threads = int(os.environ.get(NUM_THREADS_ENV_NAME, 0))
+    if not num_threads:
+        try:
+            num_threads = len(os.sched_getaffinity(0))  # respects the cpus assigned to the job
+        except AttributeError:  # not available on all platforms
+            num_threads = os.cpu_count() or 1
+    torch.set_num_threads(num_threads)
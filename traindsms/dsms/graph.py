@@ -0,0 +1,193 @@
+import numpy as np
+from scipy.sparse import csr_matrix, csgraph
+from typing import List, Dict, Any, Iterator, Tuple
+from cached_property import cached_property
+
+
+class CSRGraph:
+    """
+    compact weighted graph, stored as a scipy CSR matrix of edge weights instead of a dict of dicts.
+
+    node i is nodes[i], and nodes may be any hashable object, e.g. a word or a (nested) tuple of words.
+    a directed graph stores each edge once, an undirected graph stores each edge in both directions.
+    the methods mirror the parts of the networkx API that are used by the graph DSMs.
+    """
+
+    def __init__(self,
+                 nodes: List[Any],
+                 edge_ids: np.array,  # [num_edges, 2] unique edges (from ID, to ID)
+                 edge_weights: np.array,  # [num_edges]
+                 directed: bool,
+                 ):
+        self.nodes = nodes
+        self.edge_ids = edge_ids
+        self.edge_weights = edge_weights
+        self.directed = directed
+
+        num_nodes = len(nodes)
+        row_ids = edge_ids[:, 0]
+        col_ids = edge_ids[:, 1]
+        weights = edge_weights
+        if not directed:  # store each edge in both directions, and loops only once
+            is_loop = row_ids == col_ids
+            row_ids, col_ids = (np.concatenate([row_ids, col_ids[~is_loop]]),
+                                np.concatenate([col_ids, row_ids[~is_loop]]))
+            weights = np.concatenate([weights, weights[~is_loop]])
+        self.weight_matrix = csr_matrix((weights, (row_ids, col_ids)), shape=(num_nodes, num_nodes), dtype=float)
+        self.weight_matrix.sort_indices()
+
+    @classmethod
+    def from_weight_matrix(cls,
+                           nodes: List[Any],
+                           weight_matrix: csr_matrix,
+                           directed: bool,
+                           ) -> 'CSRGraph':
+        """build a graph with an edge for each stored entry of weight_matrix (only the upper triangle if undirected)"""
+        weight_matrix = csr_matrix(weight_matrix)
+        weight_matrix.eliminate_zeros()
+        weight_matrix = weight_matrix.tocoo()
+        is_kept = np.ones(weight_matrix.nnz, bool) if directed else weight_matrix.row <= weight_matrix.col
+        edge_ids = np.stack([weight_matrix.row[is_kept], weight_matrix.col[is_kept]], axis=1)
+        return cls(nodes, edge_ids, weight_matrix.data[is_kept], directed)
+
+    @cached_property
+    def node2id(self) -> Dict[Any, int]:
+        return {node: i for i, node in enumerate(self.nodes)}
+
+    @cached_property
+    def in_weight_matrix(self) -> csr_matrix:
+        """rows are in-edges, only needed for directed graphs"""
+        return self.weight_matrix.transpose().tocsr()
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.nodes)
+
+    def __contains__(self, node: Any) -> bool:
+        return node in self.node2id
+
+    def is_directed(self) -> bool:
+        return self.directed
+
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+    def number_of_edges(self) -> int:
+        return len(self.edge_ids)
+
+    def edges(self) -> Iterator[Tuple[Any, Any, float]]:
+        """iterate over (from node, to node, weight)"""
+        for (from_id, to_id), weight in zip(self.edge_ids.tolist(), self.edge_weights.tolist()):
+            yield self.nodes[from_id], self.nodes[to_id], weight
+
+    def has_edge(self, u: Any, v: Any) -> bool:
+        return self.weight_matrix[self.node2id[u], self.node2id[v]] != 0
+
+    def get_weight(self, u: Any, v: Any) -> float:
+        if not self.has_edge(u, v):
+            raise KeyError(f'No edge between {u} and {v}')
+        return self.weight_matrix[self.node2id[u], self.node2id[v]]
+
+    def successors(self, node: Any) -> List[Any]:
+        """nodes at the end of edges from node (all neighbors if undirected)"""
+        node_id = self.node2id[node]
+        indptr = self.weight_matrix.indptr
+        return [self.nodes[i] for i in self.weight_matrix.indices[indptr[node_id]:indptr[node_id + 1]]]
+
+    def predecessors(self, node: Any) -> List[Any]:
+        """nodes at the start of edges to node (all neighbors if undirected)"""
+        if not self.directed:
+            return self.successors(node)
+        node_id = self.node2id[node]
+        indptr = self.in_weight_matrix.indptr
+        return [self.nodes[i] for i in self.in_weight_matrix.indices[indptr[node_id]:indptr[node_id + 1]]]
+
+    def neighbors(self, node: Any) -> List[Any]:
+        return self.successors(node)
+
+    def out_degree(self, node: Any) -> int:
+        node_id = self.node2id[node]
+        return int(self.weight_matrix.indptr[node_id + 1] - self.weight_matrix.indptr[node_id])
+
+    def in_degree(self, node: Any) -> int:
+        if not self.directed:
+            return self.out_degree(node)
+        node_id = self.node2id[node]
+        return int(self.in_weight_matrix.indptr[node_id + 1] - self.in_weight_matrix.indptr[node_id])
+
+    def degree(self, node: Any) -> int:
+        """number of edges at node, where a loop counts twice, as in networkx"""
+        if self.directed:
+            return self.out_degree(node) + self.in_degree(node)
+        node_id = self.node2id[node]
+        return self.out_degree(node) + int(self.weight_matrix[node_id, node_id] != 0)
+
+    def to_undirected(self) -> 'CSRGraph':
+        """
+        return an undirected view, with an edge between 2 nodes if there is an edge in any direction.
+        if there are edges in both directions, the larger weight is kept.
+        """
+        if not self.directed:
+            return self
+        return CSRGraph.from_weight_matrix(self.nodes,
+                                           self.weight_matrix.maximum(self.weight_matrix.transpose()),
+                                           directed=False)
+
+    def subgraph(self, nodes: List[Any]) -> 'CSRGraph':
+        """return the graph induced by nodes, in the order in which they are first given"""
+        nodes = list(dict.fromkeys(nodes))
+        node_ids = [self.node2id[node] for node in nodes]
+        weight_matrix = self.weight_matrix[node_ids][:, node_ids]
+        return CSRGraph.from_weight_matrix(nodes, weight_matrix, self.directed)
+
+    def bfs(self, source: Any) -> List[Any]:
+        """return all nodes reachable from source, in breadth-first order"""
+        order = csgraph.breadth_first_order(self.weight_matrix,
+                                            self.node2id[source],
+                                            directed=self.directed,
+                                            return_predecessors=False)
+        return [self.nodes[i] for i in order]
+
+    def shortest_path_lengths(self, sources: List[Any]) -> np.array:
+        """
+        return the number of edges on the shortest path from each source (row) to each node (column),
+        or np.inf if there is no path.
+        """
+        source_ids = [self.node2id[source] for source in sources]
+        return csgraph.shortest_path(self.weight_matrix,
+                                     directed=self.directed,
+                                     unweighted=True,
+                                     indices=source_ids).reshape(len(source_ids), -1)
+
+    def diameter(self,
+                 batch_size: int = 1024,
+                 within_components: bool = False,
+                 ) -> int:
+        """
+        return the longest shortest path between any 2 nodes, computed by breadth-first search from all nodes,
+        in batches, so that the full distance matrix is never in memory.
+
+        if the graph is not connected, raise ValueError, as networkx does,
+        unless within_components, in which case the largest diameter of any connected component is returned.
+        """
+        res = 0
+        for start in range(0, len(self.nodes), batch_size):
+            lengths = self.shortest_path_lengths(self.nodes[start:start + batch_size])
+            is_finite = np.isfinite(lengths)
+            if not is_finite.all():
+                if not within_components:
+                    raise ValueError('Found infinite path length because the graph is not connected')
+                lengths = lengths[is_finite]  # each node has a finite path to itself, so this is never empty
+            res = max(res, int(lengths.max()))
+        return res
+
+    def to_networkx(self):
+        """convert to a networkx graph, e.g. for plotting"""
+        import networkx as nx
+
+        res = nx.DiGraph() if self.directed else nx.Graph()
+        res.add_nodes_from(self.nodes)
+        res.add_weighted_edges_from(self.edges())
+        return res
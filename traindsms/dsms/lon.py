@@ -1,13 +1,13 @@
 import math
+import time
 from typing import List
-import networkx as nx
+import numpy as np
 from collections import defaultdict
 
+from traindsms.dsms.graph import CSRGraph
 from traindsms.dsms.network import NetworkBaseClass
 from traindsms.params import LONParams
 
-VERBOSE = True
-
 
 class LON(NetworkBaseClass):
     """
@@ -23,84 +23,74 @@ class LON(NetworkBaseClass):
         self.params = params
         self.seq_tok = seq_tok
 
-        self.sr_bank = {}  # for caching sr scores
-
     def train(self):
 
-        # ---------------------------------
-        # collect edges and nodes
-
-        network_edges = []
-        network_nodes = []
-        for seq in self.seq_tok:
-
-            edges = []
-            for n, token in enumerate(seq):
-
-                # get token at n + 1
-                try:
-                    token_np1 = seq[n + 1]
-                except IndexError:
-                    pass
-                else:
-                    edge = (token, token_np1)
-                    edges.append(edge)
+        start_time = time.time()
 
-                if self.params.context_size != 2:
-                    continue
-
-                # get token at n + 2
-                try:
-                    token_np2 = seq[n + 2]
-                except IndexError:
-                    pass
-                else:
-                    edge = (token, token_np2)
-                    edges.append(edge)
+        # ---------------------------------
+        # map tokens to IDs
 
-            network_edges.extend(edges)
-            network_nodes.extend(seq)
+        seq_lengths = np.array([len(seq) for seq in self.seq_tok], int)
+        tokens = np.array([token for seq in self.seq_tok for token in seq], dtype=str)
+        nodes, token_ids = np.unique(tokens, return_inverse=True)
+        self.node_list = nodes.tolist()
+        seq_ids = np.repeat(np.arange(len(seq_lengths)), seq_lengths)
 
-        self.node_list = list(set(network_nodes))
+        # ---------------------------------
+        # collect edges: each token is connected to each of the next context_size tokens in the same sequence.
+        # an edge is encoded as a single integer, and stored at its position when reading the corpus token by token
+
+        context_size = self.params.context_size
+        num_nodes = len(self.node_list)
+        network_edges = np.full(len(token_ids) * context_size, -1)
+        for distance in range(1, context_size + 1):
+            is_same_seq = seq_ids[:-distance] == seq_ids[distance:]
+            positions = np.flatnonzero(is_same_seq) * context_size + distance - 1
+            from_ids = token_ids[:-distance][is_same_seq]
+            to_ids = token_ids[distance:][is_same_seq]
+            network_edges[positions] = from_ids * num_nodes + to_ids
+        network_edges = network_edges[network_edges >= 0]
 
         # ---------------------------------
         # weight edges
 
-        edge2count = {}
-        for edge in network_edges:
-            if edge in edge2count:
-                edge2count[edge] = edge2count[edge] + 1
-            else:
-                edge2count[edge] = 1
-
-        weighted_network_edge = []
-        for edge in edge2count:
-            weighted_network_edge.append(edge + (math.log10(edge2count[edge] + 1),))
-
-        if VERBOSE:
-            print()
-            print('Weighted Edges:')
-            for edge in weighted_network_edge:
-                print(self.node_list.index(edge[0]), self.node_list.index(edge[1]), edge)
-            print()
+        edge_keys, first_ids, edge_counts = np.unique(network_edges, return_index=True, return_counts=True)
+        order = np.argsort(first_ids)  # order of first occurrence
+        from_ids, to_ids = np.divmod(edge_keys[order], num_nodes)
+        edge_weights = np.log10(edge_counts[order] + 1)
+
+        # the network is undirected: if both (a, b) and (b, a) occur, the weight of the one encountered first later
+        # in the corpus is kept
+        undirected_keys, inverse = np.unique(np.minimum(from_ids, to_ids) * num_nodes + np.maximum(from_ids, to_ids),
+                                             return_inverse=True)
+        ranks = np.arange(len(edge_keys))
+        last_ranks = np.full(len(undirected_keys), -1)
+        np.maximum.at(last_ranks, inverse, ranks)
+        first_ranks = np.full(len(undirected_keys), len(edge_keys))
+        np.minimum.at(first_ranks, inverse, ranks)
+        order = np.argsort(first_ranks)
+        self.edge_ids = np.stack(np.divmod(undirected_keys[order], num_nodes), axis=1)
+        self.edge_weights = edge_weights[last_ranks[order]]
 
         # ---------------------------------
         # make network
 
-        self.network = nx.Graph()
-        self.network.add_weighted_edges_from(weighted_network_edge)
+        self.network = CSRGraph(self.node_list, self.edge_ids, self.edge_weights, directed=False)
+        self.invalidate_caches()
+
+        self.build_time = time.time() - start_time
+        self.print_summary()
 
     def calc_sr_scores(self, verb, theme, instruments):
         """compute sr scores for a single row in the blank sr data frame."""
 
-        if verb not in self.sr_bank:
-            self.sr_bank[verb] = self.activation_spreading_analysis(verb, instruments, [])
-        if theme not in self.sr_bank:
-            self.sr_bank[theme] = self.activation_spreading_analysis(theme, instruments, [])
+        # activations are cached per source in NetworkBaseClass
+        sr_verb = self.activation_spreading_analysis(verb, instruments, [])
+        sr_theme = self.activation_spreading_analysis(theme, instruments, [])
 
         scores = []
         for instrument in instruments:  # instrument columns start after the 3rd column
-            sr = math.log(self.sr_bank[verb][instrument] * self.sr_bank[theme][instrument])
+            sr = math.log(sr_verb[instrument] * sr_theme[instrument])
             scores.append(sr)
 
         return scores
@@ -1,10 +1,65 @@
-import networkx as nx
+import math
+import pickle
 import numpy as np
-from scipy.sparse import lil_matrix
-from typing import List, Dict
+from pathlib import Path
+from scipy.sparse import csr_matrix
+from typing import List, Dict, Any, Optional, Tuple
+from collections import defaultdict, namedtuple, OrderedDict
 from cached_property import cached_property
 
+from traindsms.dsms.graph import CSRGraph
+
 VERBOSE = False
+ACTIVATION_CACHE_SIZE = 1024  # max number of (source, excluded edges) whose activations are kept in memory
+EXPORT_GRAPH = False  # write the weighted edge list and node table to save_path after training, for debugging
+PRECOMPUTE_ACTIVATIONS = False  # store activations of instruments for all sources in save_path before scoring
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class ActivationTable:
+    """
+    activations of targets (columns) by spreading activation from (source, excluded edges) pairs (rows),
+    stored in activations.npy and activation_index.pkl, and memory-mapped, so that only the slices read are loaded.
+    """
+
+    activations_file_name = 'activations.npy'
+    index_file_name = 'activation_index.pkl'
+
+    def __init__(self, path: Path):
+        self.activations = np.load(path / self.activations_file_name, mmap_mode='r')
+        with open(path / self.index_file_name, 'rb') as f:
+            keys, self.targets = pickle.load(f)
+        self.key2row = {key: row for row, key in enumerate(keys)}
+        self.target2col = {target: col for col, target in enumerate(self.targets)}
+
+    def __contains__(self, key: Tuple[Any, frozenset]) -> bool:
+        return key in self.key2row
+
+    def get_activations(self,
+                        sources: List[Any],
+                        excluded_edges_list: List[List[Tuple]],  # one list per source
+                        targets: List[Any],
+                        ) -> np.array:
+        """return the activations of targets, one row per source, [num_sources, num_targets]"""
+        rows = [self.key2row[(source, frozenset(excluded_edges))]
+                for source, excluded_edges in zip(sources, excluded_edges_list)]
+        cols = [self.target2col[target] for target in targets]
+        return np.asarray(self.activations[np.ix_(rows, cols)])
+
+    @classmethod
+    def save(cls,
+             path: Path,
+             keys: List[Tuple[Any, frozenset]],
+             targets: List[Any],
+             ) -> np.memmap:
+        """write the index, and return the memory-mapped table, to be filled in by the caller"""
+        with open(path / cls.index_file_name, 'wb') as f:
+            pickle.dump((keys, targets), f)
+        return np.lib.format.open_memmap(path / cls.activations_file_name,
+                                         mode='w+',
+                                         dtype=float,
+                                         shape=(len(keys), len(targets)))
 
 
 class NetworkBaseClass:
@@ -13,25 +68,125 @@ class NetworkBaseClass:
     """
 
     def __init__(self):
-        self.network = None
+        self.network: Optional[CSRGraph] = None
         self.node_list = []
+        self.edge_ids = None  # unique edges (from ID, to ID), int array [num_edges, 2]
+        self.edge_weights = None
+        self.build_time = None  # seconds taken to build the network
 
-        self.path_distance_dict = {node: {} for node in self.node_list}
-        # keys are nodes, values are distances from the key node to all other nodes in the graph.
+        # least-recently-used cache of spread activations, keyed on (source, frozenset(excluded_edges))
+        self.activation_cache = OrderedDict()
+        self.activation_cache_hits = 0
+        self.activation_cache_misses = 0
+        self.activation_table: Optional[ActivationTable] = None  # precomputed activations of targets, on disk
 
         print('Initialized NetworkBaseClass')
 
+    def invalidate_caches(self) -> None:
+        """
+        discard everything computed from the network.
+        must be called whenever the network or node_list changes, e.g. at the end of training.
+        """
+        for name in ['adjacency_matrix', 'node2id', 'id2node', 'undirected_network', 'diameter']:
+            self.__dict__.pop(name, None)  # cached properties are stored in the instance dict
+        self.activation_cache.clear()
+        self.activation_table = None
+
+    def get_summary(self) -> Dict[str, float]:
+        num_nodes = len(self.node_list)
+        num_edges = len(self.edge_ids)
+        num_possible_edges = num_nodes * (num_nodes - 1)
+        if not self.network.is_directed():
+            num_possible_edges /= 2
+        return {'num_nodes': num_nodes,
+                'num_edges': num_edges,
+                'density': num_edges / num_possible_edges if num_possible_edges else 0.0,
+                'build_time': self.build_time,
+                }
+
+    def print_summary(self) -> None:
+        summary = self.get_summary()
+        print(f'Built {self.__class__.__name__} with {summary["num_nodes"]:,} nodes and {summary["num_edges"]:,} edges '
+              f'(density={summary["density"]:.6f}) in {summary["build_time"]:.2f}s', flush=True)
+
+    def export_graph(self, save_path: Path) -> None:
+        """
+        write the weighted edge list to edges.npz and the node table to nodes.tsv in save_path.
+        the node in row i of nodes.tsv has ID i in edges.npz.
+        """
+        np.savez_compressed(save_path / 'edges.npz',
+                            from_ids=self.edge_ids[:, 0],
+                            to_ids=self.edge_ids[:, 1],
+                            weights=self.edge_weights)
+        with open(save_path / 'nodes.tsv', 'w') as f:
+            f.write('id\tnode\n')
+            for node_id, node in enumerate(self.node_list):
+                f.write(f'{node_id}\t{node}\n')
+        print(f'Exported {len(self.edge_ids):,} edges and {len(self.node_list):,} nodes to {save_path}')
+
+    def activation_cache_info(self) -> CacheInfo:
+        return CacheInfo(self.activation_cache_hits,
+                         self.activation_cache_misses,
+                         ACTIVATION_CACHE_SIZE,
+                         len(self.activation_cache))
+
+    def _cache_activation(self, key: Tuple, activation_recorder: np.array) -> None:
+        activation_recorder.flags.writeable = False  # cached activations are shared between callers
+        self.activation_cache[key] = activation_recorder
+        if len(self.activation_cache) > ACTIVATION_CACHE_SIZE:
+            self.activation_cache.popitem(last=False)
+
+    def get_activation(self,
+                       source: Any,
+                       excluded_edges,  # a list of directed edges (e.g.(a,b)) that are excluded
+                       ) -> np.array:
+        """
+        return the result of spread_activation(), computing it only if it is not in the activation cache.
+        """
+        key = (source, frozenset(excluded_edges))
+        if key in self.activation_cache:
+            self.activation_cache_hits += 1
+            self.activation_cache.move_to_end(key)
+            return self.activation_cache[key]
+
+        self.activation_cache_misses += 1
+        activation_recorder = self.spread_activation(source, excluded_edges)
+        self._cache_activation(key, activation_recorder)
+        return activation_recorder
+
     @cached_property
-    def adjacency_matrix(self) -> np.array:
+    def adjacency_matrix(self) -> csr_matrix:
         return self.get_adjacency_matrix()
 
+    @cached_property
+    def node2id(self) -> Dict[Any, int]:
+        """
+        map each node to its row in the adjacency matrix.
+        built once, after training, so that looking up a node does not require a linear scan of node_list.
+        """
+        if self.network is not None and self.network.nodes is self.node_list:
+            return self.network.node2id  # share the mapping of the network
+        return {node: i for i, node in enumerate(self.node_list)}
+
+    @cached_property
+    def id2node(self) -> np.array:
+        """map each row in the adjacency matrix to its node"""
+        res = np.empty(len(self.node_list), dtype=object)
+        for i, node in enumerate(self.node_list):  # nodes may be tuples, which must not be unpacked by numpy
+            res[i] = node
+        return res
+
     @cached_property
     def undirected_network(self):
         return self.network.to_undirected()
 
     @cached_property
-    def diameter(self):
-        return nx.algorithms.distance_measures.diameter(self.undirected_network)
+    def diameter(self) -> int:
+        """
+        the longest shortest path within any connected component of the undirected network.
+        the network need not be connected, e.g. a LON has an isolated node for each word only seen on its own.
+        """
+        return self.undirected_network.diameter(within_components=True)
 
     def get_sized_neighbor_node(self, graph, node, size):
         """
@@ -44,7 +199,7 @@ class NetworkBaseClass:
         while i < size:
             for node in neighbor_node_dict:
                 if neighbor_node_dict[node] == i:
-                    for neighbor_node in graph[node]:
+                    for neighbor_node in graph.neighbors(node):
                         neighbor_node_list.append(neighbor_node)
             for node in neighbor_node_list:
                 if node not in neighbor_node_dict:
@@ -57,28 +212,302 @@ class NetworkBaseClass:
         """
         return the sized neighborhood of a given node
         """
-        net = self.network[2].to_undirected()
+        net = self.undirected_network
         choice_neighbor = self.get_sized_neighbor_node(net, node, size)
         choice_net = net.subgraph(choice_neighbor)
         return choice_net
 
-    def get_adjacency_matrix(self):
-        adj_mat = nx.adjacency_matrix(self.network, nodelist=self.node_list)
-        adj_mat.todense()
-        length = adj_mat.shape[0]
-        adj_mat = adj_mat + np.transpose(adj_mat)
-        adj_mat = lil_matrix(adj_mat)
+    def get_weight_matrix(self) -> csr_matrix:
+        """return the matrix of edge weights, with rows and columns in the order of node_list"""
+        return self.network.weight_matrix
+
+    def get_adjacency_matrix(self) -> csr_matrix:
+        """
+        return the row-normalized adjacency matrix of the network, symmetrized by adding its transpose.
+        rows of nodes without edges are left at zero.
+        """
+        adj_mat = self.get_weight_matrix()
+        adj_mat = (adj_mat + adj_mat.transpose()).tocsr()
+        adj_mat.sort_indices()
 
-        normalizer = adj_mat.sum(1)
-        for i in range(length):
-            for j in range(length):
-                if normalizer[i][0, 0] == 0:
-                    adj_mat[i, j] = 0
-                else:
-                    adj_mat[i, j] = adj_mat[i, j] / normalizer[i][0, 0]
+        # divide each stored entry by the sum of its row
+        normalizer = adj_mat @ np.ones(adj_mat.shape[1])  # sums in the same order as the former lil_matrix.sum(1)
+        row_ids = np.repeat(np.arange(adj_mat.shape[0]), np.diff(adj_mat.indptr))
+        adj_mat.data = adj_mat.data / normalizer[row_ids]
+        adj_mat.eliminate_zeros()
 
         return adj_mat
 
+    def get_masked_adjacency_matrix(self,
+                                    excluded_edges,  # a list of directed edges (e.g.(a,b)) that are excluded
+                                    ) -> csr_matrix:
+        """
+        return the adjacency matrix with excluded edges set to zero.
+
+        only the data array is copied; the sparsity structure is shared with the cached adjacency matrix.
+        """
+        adj_mat = self.adjacency_matrix
+        if not excluded_edges:
+            return adj_mat
+
+        data = adj_mat.data.copy()
+        for edge in excluded_edges:
+            from_id = self.node2id[edge[0]]
+            to_id = self.node2id[edge[1]]
+            start, end = adj_mat.indptr[from_id], adj_mat.indptr[from_id + 1]
+            data[start:end][adj_mat.indices[start:end] == to_id] = 0
+        return csr_matrix((data, adj_mat.indices, adj_mat.indptr), shape=adj_mat.shape)
+
+    def spread_activation(self,
+                          source: Any,
+                          excluded_edges,  # a list of directed edges (e.g.(a,b)) that are excluded
+                          ) -> np.array:
+        """
+        spread activation from source through the network, until no more nodes can be reached.
+
+        return the activation recorded at each node:
+        the activation that arrives at a node when it is first reached, and at the step after that.
+
+        Note:
+            only rows of nodes in the frontier (nodes with non-zero activation) take part in the matrix product.
+        """
+
+        adj_mat = self.get_masked_adjacency_matrix(excluded_edges)
+        length = adj_mat.shape[0]
+
+        activation = np.zeros(length, float)
+        activation[self.node2id[source]] = 1  # source is activated
+        not_fired = np.ones(length, bool)
+        not_fired[self.node2id[source]] = False  # source has fired
+        for edge in excluded_edges:
+            not_fired[self.node2id[edge[1]]] = False  # avoided node is considered as fired
+        last_fired = np.zeros(length, bool)
+        activation_recorder = activation.copy()
+        reached = activation != 0
+
+        is_spreading = True
+        while is_spreading and (not_fired.any() or last_fired.any()):
+            frontier = np.flatnonzero(activation)
+            if len(frontier) < length // 2:
+                activation = activation[frontier] @ adj_mat[frontier]
+            else:
+                activation = activation @ adj_mat
+
+            # record the first time arrived
+            # activation, which stands for the semantic relatedness from the source to the activated node
+            is_recorded = not_fired | last_fired
+            activation_recorder[is_recorded] += activation[is_recorded]
+
+            # a node which has not fired get activated, automatically updated to fired
+            last_fired = not_fired & (activation != 0)
+            not_fired[last_fired] = False
+
+            # once a step activates no node for the first time, no node can be reached anymore
+            # (e.g. isolated nodes, or nodes only reachable through excluded edges)
+            newly_reached = (activation != 0) & ~reached
+            reached |= newly_reached
+            is_spreading = newly_reached.any()
+
+        return activation_recorder
+
+    def spread_activation_batch(self,
+                                sources: List[Any],
+                                excluded_edges_list: Optional[List[List[Tuple]]] = None,  # one list per source
+                                batch_size: int = 256,
+                                ) -> np.array:
+        """
+        spread activation from multiple sources at once, each with its own fired masks and excluded edges.
+
+        return the activation recorded at each node, one row per source, [num_sources, num_nodes].
+        each row is identical to the result of spread_activation() for the same source and excluded edges.
+
+        Note:
+            excluded edges are not removed from the shared adjacency matrix.
+            instead, activation arriving at the target of an excluded edge is re-computed without that edge,
+            in the same order of summation as a matrix product with the edge set to zero.
+        """
+        if excluded_edges_list is None:
+            excluded_edges_list = [[] for _ in sources]
+        if len(excluded_edges_list) != len(sources):
+            raise ValueError('Need exactly one list of excluded edges per source.')
+
+        # only spread activation from sources that are not in the activation cache
+        keys = [(source, frozenset(excluded_edges)) for source, excluded_edges in zip(sources, excluded_edges_list)]
+        key2activation = {}
+        key2excluded_edges = {}
+        for key, excluded_edges in zip(keys, excluded_edges_list):
+            if key in key2activation or key in key2excluded_edges:  # duplicate source in this batch
+                self.activation_cache_hits += 1
+            elif key in self.activation_cache:
+                self.activation_cache_hits += 1
+                self.activation_cache.move_to_end(key)
+                key2activation[key] = self.activation_cache[key]  # keep, in case it is evicted below
+            else:
+                self.activation_cache_misses += 1
+                key2excluded_edges[key] = excluded_edges
+        missed_keys = list(key2excluded_edges)
+
+        for start in range(0, len(missed_keys), batch_size):
+            batch_keys = missed_keys[start:start + batch_size]
+            activations = self._spread_activation_batch([key[0] for key in batch_keys],
+                                                        [key2excluded_edges[key] for key in batch_keys])
+            for key, activation_recorder in zip(batch_keys, activations):
+                activation_recorder = activation_recorder.copy()  # a row view would keep the whole batch in memory
+                key2activation[key] = activation_recorder
+                self._cache_activation(key, activation_recorder)
+
+        res = np.zeros((len(sources), len(self.node_list)), float)
+        for n, key in enumerate(keys):
+            res[n] = key2activation[key]
+        return res
+
+    def precompute_activations(self,
+                               sources: List[Any],
+                               excluded_edges_list: List[List[Tuple]],  # one list per source
+                               targets: List[Any],
+                               save_path: Path,
+                               batch_size: int = 256,
+                               ) -> None:
+        """
+        spread activation once from each unique (source, excluded edges) pair,
+        and store the activations of targets in a memory-mapped table in save_path.
+        afterwards, get_target_activations() reads slices of the table instead of spreading activation.
+        """
+        key2excluded_edges = {}
+        for source, excluded_edges in zip(sources, excluded_edges_list):
+            key2excluded_edges.setdefault((source, frozenset(excluded_edges)), excluded_edges)
+        keys = list(key2excluded_edges)
+        target_ids = [self.node2id[target] for target in targets]
+
+        table = ActivationTable.save(save_path, keys, targets)
+        for start in range(0, len(keys), batch_size):
+            batch_keys = keys[start:start + batch_size]
+            activations = self._spread_activation_batch([key[0] for key in batch_keys],
+                                                        [key2excluded_edges[key] for key in batch_keys])
+            table[start:start + len(batch_keys)] = activations[:, target_ids]
+        table.flush()
+        del table
+
+        self.load_activation_table(save_path)
+        print(f'Precomputed activations of {len(targets)} targets from {len(keys):,} sources', flush=True)
+
+    def load_activation_table(self, save_path: Path) -> None:
+        self.activation_table = ActivationTable(save_path)
+
+    def get_target_activations(self,
+                               sources: List[Any],
+                               excluded_edges_list: List[List[Tuple]],  # one list per source
+                               targets: List[Any],
+                               ) -> np.array:
+        """
+        return the activations of targets, one row per source, [num_sources, num_targets].
+        read from the precomputed activation table, if it has all sources and targets, otherwise spread activation.
+        """
+        table = self.activation_table
+        if table is not None \
+                and all(target in table.target2col for target in targets) \
+                and all((source, frozenset(excluded_edges)) in table
+                        for source, excluded_edges in zip(sources, excluded_edges_list)):
+            return table.get_activations(sources, excluded_edges_list, targets)
+
+        target_ids = [self.node2id[target] for target in targets]
+        return self.spread_activation_batch(sources, excluded_edges_list)[:, target_ids]
+
+    def get_verb_phrase_sources(self,
+                                verb_phrases: List[Tuple[str, str]],
+                                ) -> Tuple[List[Any], List[List[Tuple]]]:
+        """
+        return the sources, and the excluded edges of each, from which activation is spread to score verb phrases:
+        the verb and the theme of each verb phrase, in that order.
+        """
+        sources = [word for verb_phrase in verb_phrases for word in verb_phrase]
+        return sources, [[] for _ in sources]
+
+    def calc_sr_scores_batch(self,
+                             verb_phrases: List[Tuple[str, str]],
+                             instruments: List[str],
+                             ) -> List[List[float]]:
+        """compute sr scores for all rows in the blank sr data frame, by spreading activation from all sources at once."""
+
+        sources, excluded_edges_list = self.get_verb_phrase_sources(verb_phrases)
+        activations = self.get_target_activations(sources, excluded_edges_list, instruments)
+
+        res = []
+        for n in range(len(verb_phrases)):
+            sr_verb = activations[2 * n]
+            sr_theme = activations[2 * n + 1]
+            res.append([math.log(sr) for sr in sr_verb * sr_theme])
+
+        return res
+
+    def _spread_activation_batch(self,
+                                 sources: List[Any],
+                                 excluded_edges_list: List[List[Tuple]],
+                                 ) -> np.array:
+        adj_mat = self.adjacency_matrix
+        adj_mat_csc = adj_mat.tocsc()
+        adj_mat_csc.sort_indices()
+        length = adj_mat.shape[0]
+        num_sources = len(sources)
+        source_ids = np.array([self.node2id[source] for source in sources], int)
+
+        activation = np.zeros((num_sources, length), float)
+        activation[np.arange(num_sources), source_ids] = 1  # sources are activated
+        not_fired = np.ones((num_sources, length), bool)
+        not_fired[np.arange(num_sources), source_ids] = False  # sources have fired
+
+        # map (source row, target of excluded edge) to the origins of the excluded edges into that target
+        excluded2from_ids = defaultdict(set)
+        for n, excluded_edges in enumerate(excluded_edges_list):
+            for edge in excluded_edges:
+                to_id = self.node2id[edge[1]]
+                excluded2from_ids[n, to_id].add(self.node2id[edge[0]])
+                not_fired[n, to_id] = False  # avoided node is considered as fired
+
+        last_fired = np.zeros((num_sources, length), bool)
+        activation_recorder = activation.copy()
+        reached = activation != 0
+
+        # rows of sources whose spread has not died out, and which have nodes left to record
+        rows = np.arange(num_sources)
+        while len(rows):
+            frontier = np.flatnonzero(activation[rows].any(axis=0))
+            activation_next = np.zeros_like(activation)
+            if len(frontier) < length // 2:
+                activation_next[rows] = activation[np.ix_(rows, frontier)] @ adj_mat[frontier]
+            else:
+                activation_next[rows] = activation[rows] @ adj_mat
+
+            # correction for excluded edges
+            for (n, to_id), from_ids in excluded2from_ids.items():
+                if not activation[n, list(from_ids)].any():
+                    continue
+                start, end = adj_mat_csc.indptr[to_id], adj_mat_csc.indptr[to_id + 1]
+                total = 0.0
+                for from_id, weight in zip(adj_mat_csc.indices[start:end].tolist(),
+                                           adj_mat_csc.data[start:end].tolist()):
+                    if from_id not in from_ids:
+                        total += weight * activation[n, from_id]
+                activation_next[n, to_id] = total
+            activation = activation_next
+
+            # record the first time arrived
+            is_recorded = not_fired | last_fired
+            activation_recorder[is_recorded] += activation[is_recorded]
+
+            # a node which has not fired get activated, automatically updated to fired
+            last_fired = not_fired & (activation != 0)
+            not_fired[last_fired] = False
+
+            # as in spread_activation(), but per source: finished rows are dropped, and their activation is zeroed
+            newly_reached = (activation != 0) & ~reached
+            reached |= newly_reached
+            is_spreading = newly_reached.any(axis=1) & (not_fired.any(axis=1) | last_fired.any(axis=1))
+            activation[~is_spreading] = 0
+            rows = np.flatnonzero(is_spreading)
+
+        return activation_recorder
+
     def activation_spreading_analysis(self,
                                       source: str,
                                       targets: List[str],
@@ -90,72 +519,48 @@ class NetworkBaseClass:
         return a sr_dictionary consisting of sr from the source to all targets
         """
 
-        adj_mat = self.adjacency_matrix.copy()
-        length = adj_mat.shape[0]
-
-        activation = np.zeros((1, length), float)
-        fired = np.ones((1, length), float)
-        activation[0, self.node_list.index(source)] = 1  # source is activated
-        fired[0, self.node_list.index(source)] = 0  # source has fired
-        for edge in excluded_edges:
-            from_id = self.node_list.index(edge[0])
-            to_id = self.node_list.index(edge[1])
-            adj_mat[from_id, to_id] = 0
-            fired[0, to_id] = 0 # avoided node is considered as fired
-        activation_recorder = activation
-        last_fired = np.zeros((1, length), float)
-
-        while fired.any() or last_fired.any():
-            activation = activation * adj_mat
-            activation_recorder = activation_recorder + np.multiply(fired, activation) + \
-                                  np.multiply(last_fired,activation)
-            # record the first time arrived
-            # activation, which stands for the semantic relatedness from the source to the activated node
-            last_fired = np.zeros((1,length),float)
-            for i in range(length):
-                # a node which has not fired get activated, automatically updated to fired
-                if fired[0, i] == 1 and activation[0, i] != 0:
-                    fired[0, i] = 0
-                    last_fired[0, i] = 1
-
-        sorted_activation = activation_recorder.tolist()[0]
-        sorted_activation.sort(reverse=True)
-
-        # node_dict = {}
-        # sorted_dict = {}
-        # if dg == 'constituent':
-        #     for node in node_list:
-        #         node_dict[node] = activation_recorder[0,node_list.index(node)]
-        #         sorted_dict = {k: v for k, v in sorted(node_dict.items(), key=lambda item: item[1], reverse=True)}
-        #     for node in sorted_dict:
-        #         print((node, sorted_dict[node]))
+        activation_recorder = self.get_activation(source, excluded_edges)
 
         semantic_relatedness_dict = {}
         for word in targets:
-            semantic_relatedness_dict[word] = activation_recorder[0, self.node_list.index(word)]
+            semantic_relatedness_dict[word] = activation_recorder[self.node2id[word]]
 
         return semantic_relatedness_dict
 
-    def get_path_distance(self, source, source_activation, visited):  # TODO is this needed?
-        """
-        for a given node, get the activation-spreading distance to all other nodes in the graph through all paths
+    def get_walk_activation(self,
+                            sources: Optional[List[Any]] = None,
+                            max_length: Optional[int] = None,
+                            decay: float = 1.0,
+                            batch_size: int = 1024,
+                            ) -> np.array:
         """
+        for each source (row), return the activation of every node (column), summed over all walks from the source
+        of at most max_length edges. the activation along a walk is the product of the adjacency matrix entries
+        of its edges, times decay ** (number of edges).
 
-        if len(visited) == 0:
-            print('Getting activation from ' + str(source))
+        computed by dynamic programming over walk lengths, for a batch of sources at once:
+        activations along walks of length l + 1 are activations along walks of length l times the adjacency matrix.
+        this takes O(max_length * num_sources * num_edges), rather than enumerating each path.
 
-        visited.append(source)
+        by default, all nodes are sources and max_length is 2 * diameter - 1,
+        where diameter is the largest diameter of any connected component.
+        """
+        if sources is None:
+            sources = self.node_list
+        if max_length is None:
+            max_length = 2 * self.diameter - 1
 
-        original_source = visited[0]
-        if source not in self.path_distance_dict[original_source]:
-            # create the dict for all paths from the original source to the node focusing on
-            self.path_distance_dict[original_source][source] = {tuple(visited): source_activation}
-        else:
-            self.path_distance_dict[original_source][source][tuple(visited)] = source_activation
+        adj_mat = self.adjacency_matrix
+        source_ids = np.array([self.node2id[source] for source in sources], int)
+        res = np.zeros((len(source_ids), adj_mat.shape[0]), float)
+        for start in range(0, len(source_ids), batch_size):
+            batch_ids = source_ids[start: start + batch_size]
+            activation = np.zeros((len(batch_ids), adj_mat.shape[0]), float)
+            activation[np.arange(len(batch_ids)), batch_ids] = 1.0  # walks of length 0
+            summed_activation = activation.copy()
+            for _ in range(max_length):
+                activation = (adj_mat.T @ activation.T).T * decay
+                summed_activation += activation
+            res[start: start + len(batch_ids)] = summed_activation
 
-        if len(visited) < 2*self.diameter:
-            for node in self.undirected_network.neighbors(source):
-                if node not in visited:
-                    node_activation = source_activation * \
-                                      self.adjacency_matrix[self.node_list.index(source), self.node_list.index(node)]
-                    self.get_path_distance(node, node_activation, visited.copy())
+        return res
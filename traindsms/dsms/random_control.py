@@ -46,3 +46,14 @@ class RandomControlDSM:
         scores = np.random.uniform(-1, +1, len(instruments)).tolist()
 
         return scores
+
+    def calc_native_sr_scores_batch(self,
+                                    verb_phrases: List[Tuple[str, str]],
+                                    instruments: List[str],
+                                    ) -> np.array:
+        """
+        random scores for all verb phrases, [num_verb_phrases, num_instruments].
+
+        these are the same as calling calc_native_sr_scores once for each verb phrase, in order.
+        """
+        return np.random.uniform(-1, +1, (len(verb_phrases), len(instruments)))
@@ -2,7 +2,7 @@ import torch
 import pyprind
 import numpy as np
 import sys
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Iterator, Tuple
 from collections import defaultdict
 import pandas as pd
 from pathlib import Path
@@ -10,9 +10,127 @@ import random
 import torch
 import yaml
 
-from missingadjunct.corpus import Corpus
-
 from traindsms.params import RNNParams, Params
+from traindsms.dsms.device import get_device
+
+EVAL_BATCH_SIZE = 4096  # sequences per forward pass when evaluating, which is limited only by memory
+
+
+def count_unique_sequences(seq_num: List[List[int]],
+                           ) -> Tuple[List[List[int]], np.array]:
+    """
+    return each unique sequence, in order of first occurrence, and the number of times it occurs.
+
+    sequences are hashed as tuples, so that this is linear in the number of sequences.
+    """
+    seq2count = defaultdict(int)
+    for s in seq_num:
+        seq2count[tuple(s)] += 1
+    seq_num_unique = [list(s) for s in seq2count]
+    counts = np.fromiter(seq2count.values(), dtype=np.int64, count=len(seq2count))
+    return seq_num_unique, counts
+
+
+class BatchStore:
+    """
+    sequences of token IDs, converted once into one contiguous int64 tensor per sequence length.
+
+    batches of sequences with the same length are gathered from (or, for evaluation, are slices of) these tensors,
+    so that no padding is needed, and nothing is converted from python lists after construction.
+    optionally, each sequence has a count, e.g. the number of times a unique sequence occurs in the corpus.
+    """
+
+    def __init__(self,
+                 seq_num: List[List[int]],  # sequences of token IDs
+                 device: torch.device,
+                 counts: Optional[np.array] = None,  # [num_sequences] number of times each sequence occurs
+                 ):
+        self.num_sequences = len(seq_num)
+        self.lengths = np.array([len(s) for s in seq_num], dtype=np.int64)
+        if counts is None:
+            counts = np.ones(self.num_sequences, dtype=np.int64)
+        if len(counts) != self.num_sequences:
+            raise ValueError('Number of counts must be equal to number of sequences')
+        self.counts = counts
+
+        # row of each sequence in the tensor of its length
+        length2seq_group = defaultdict(list)
+        self.rows = np.zeros(self.num_sequences, dtype=np.int64)
+        for n, s in enumerate(seq_num):
+            self.rows[n] = len(length2seq_group[len(s)])
+            length2seq_group[len(s)].append(s)
+        self.length2tensor = {seq_len: torch.tensor(seq_group, dtype=torch.long, device=device)
+                              for seq_len, seq_group in length2seq_group.items()}
+        self.length2counts = {seq_len: torch.tensor(counts[self.lengths == seq_len], device=device)
+                              for seq_len in self.length2tensor}
+        for k, v in self.length2tensor.items():
+            print(f'Found {len(v):>12,} sequences with length={k:>6}', flush=True)
+
+        # sequences are shuffled in place across epochs (as if the list of sequences were shuffled each epoch)
+        self.order = np.arange(self.num_sequences)
+
+    def __len__(self):
+        return self.num_sequences
+
+    @property
+    def num_total(self) -> int:
+        """number of sequences, including repetitions"""
+        return int(self.counts.sum())
+
+    def gen_batches(self,
+                    batch_size: int,
+                    ) -> Iterator[torch.Tensor]:
+        """
+        generate batches of complete sequences for predicting next-tokens, [batch_size, seq_len].
+
+        Note:
+        each token in each sequence must be predicted during training.
+        this function does not return moving windows.
+        sequences are shuffled by permuting the order of rows, and each batch is gathered from the rows of its tensor,
+        so that a tensor is never copied as a whole.
+        """
+        self.order = self.order[np.random.permutation(self.num_sequences)]
+        yield from self._gen_batches(self.order, batch_size)
+
+    def gen_sampled_batches(self,
+                            batch_size: int,
+                            ) -> Iterator[torch.Tensor]:
+        """
+        generate batches of as many sequences as there are in total (num_total),
+        sampled with replacement, with probability proportional to their count.
+
+        only indices are repeated, so that repeated sequences are never stored.
+        """
+        num_samples = np.random.multinomial(self.num_total, self.counts / self.num_total)
+        order = np.random.permutation(np.repeat(np.arange(self.num_sequences), num_samples))
+        yield from self._gen_batches(order, batch_size)
+
+    def gen_eval_batches(self,
+                         batch_size: int,
+                         ) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        generate batches of sequences [batch_size, seq_len], and their counts [batch_size], without shuffling.
+
+        each batch is a view of the tensors built at construction, so that nothing is copied, and the random state
+        is left untouched, which is all that is needed for evaluation.
+        """
+        for seq_len, tensor in self.length2tensor.items():
+            counts = self.length2counts[seq_len]
+            for start in range(0, len(tensor), batch_size):
+                yield tensor[start:start + batch_size], counts[start:start + batch_size]
+
+    def _gen_batches(self,
+                     order: np.array,  # indices of sequences, in the order in which they are batched
+                     batch_size: int,
+                     ) -> Iterator[torch.Tensor]:
+        # lengths are visited in the order in which they first occur in order
+        ordered_lengths = self.lengths[order]
+        _, first_ids = np.unique(ordered_lengths, return_index=True)
+        for seq_len in ordered_lengths[np.sort(first_ids)]:
+            tensor = self.length2tensor[seq_len]
+            rows = torch.from_numpy(self.rows[order[ordered_lengths == seq_len]]).to(tensor.device)
+            for start in range(0, len(rows), batch_size):
+                yield tensor[rows[start:start + batch_size]]  # if end index is too large, small batch is created
 
 
 class RNN:
@@ -22,6 +140,7 @@ class RNN:
                         param_path: Path,
                         ):
         """Load RNN from saved state_dict"""
+        from missingadjunct.corpus import Corpus  # only needed to get the vocab of a pretrained model
 
         # get params
         with (param_path / 'param2val.yaml').open('r') as f:
@@ -50,6 +169,7 @@ class RNN:
 
         # load state_dict into instance
         dsm.model.load_state_dict(state_dict)
+        dsm.device = torch.device('cpu')
         dsm.model.cpu()
         print(f'Loaded model from {path_cpt}')
 
@@ -73,6 +193,7 @@ class RNN:
 
         self.vocab_size = len(token2id)
         self.id2token = {i: token for token, i in self.token2id.items()}
+        self.device = get_device(self.params.device)
 
         self.model = TorchRNN(self.params.rnn_type,
                               self.params.num_layers,
@@ -84,90 +205,55 @@ class RNN:
         self.t2e = None
         self.performance = defaultdict(list)
 
-    def gen_batches(self,
-                    seq_num: List[List[int]],  # sequences of token IDs
-                    batch_size: Optional[int] = None,
-                    ):
+    def calc_pp(self,
+                batch_store: BatchStore,
+                verbose: bool,
+                ):
         """
-        generate sequences for predicting next-tokens.
+        return the perplexity of all predicted tokens, where each sequence is weighted by its count,
+        so that a store of unique sequences with counts gives the same result as the store of all sequences.
 
         Note:
-        each token in each sequence must be predicted during training.
-        this function does not return moving windows.
+            this is exp(mean cross-entropy per predicted token), which is why the metrics are called
+            pp_train_per_token and pp_val_per_token. it is not comparable to pp_train and pp_val of earlier runs,
+            which were exp(mean of per-batch mean cross-entropy), over unique training sequences, each counted once.
         """
-
-        print(f'Generating batches for {len(seq_num)} sequences', flush=True)
-
-        if batch_size is None:
-            batch_size = self.params.batch_size
-
-        # shuffle and flatten
-        np.random.shuffle(seq_num)
-
-        # separate sequences by length to avoid padding batches
-        length2seq_group = defaultdict(list)
-        for s in seq_num:
-            length2seq_group[len(s)].append(s)
-        for k, v in length2seq_group.items():
-            print(f'Found {len(v):>12,} sequences with length={k:>6}', flush=True)
-
-        # collect sequences of same length into batches
-        for seq_len, seq_group in length2seq_group.items():
-
-            is_leftover_batch = len(seq_group) % batch_size != 0
-            num_batches = len(seq_group) // batch_size + int(is_leftover_batch)
-            for i in range(num_batches):
-                start = batch_size * i
-                seq_b = seq_group[start:start + batch_size]  # if end index is too large, small batch is created
-                if len(seq_b) != batch_size:
-                    print(f'Found abnormal batch_size={len(seq_b)}')  # this is by design
-
-                yield seq_b
-
-    def calc_pp(self,
-                seq_num: List[List[int]],  # sequences of token IDs
-                verbose: bool,
-                ):
         if verbose:
             print('Calculating perplexity...')
 
         self.model.eval()
 
-        loss_total = 0
-        num_loss = 0
-        for seq_b in self.gen_batches(seq_num):
-
-            # forward step
-            input_ids = torch.LongTensor(seq_b).cuda()[:, :-1]  # batch_first=True
-            logits = self.model(input_ids)  # logits at all time steps [batch_size * seq_len, vocab_size]
+        # losses are summed on the device, to avoid waiting for a copy to the host after each batch
+        loss_total = torch.zeros((), dtype=torch.float64, device=self.device)
+        for seq_b, counts_b in batch_store.gen_eval_batches(EVAL_BATCH_SIZE):
+            loss_per_seq = self.model.calc_loss_per_sequence(seq_b)  # [batch_size]
+            loss_total += (loss_per_seq * counts_b).sum()
 
-            # backward step
-            self.optimizer.zero_grad()  # sets all gradients to zero
-            labels = torch.LongTensor(seq_b).cuda()[:, 1:]
-            labels = torch.flatten(labels)
-            loss = self.criterion(logits,  # [batch_size * seq_len, vocab_size]
-                                  labels)  # [batch_size * seq_len]
-            loss_total += loss.item()
-            num_loss += 1
-
-        res = np.exp(loss_total / num_loss)
+        num_tokens = np.sum(batch_store.counts * (batch_store.lengths - 1))  # the first token is not predicted
+        res = np.exp(loss_total.item() / num_tokens)
         return res
 
     def train_epoch(self,
-                    seq_num: List[List[int]],  # sequences of token IDs
+                    batch_store: BatchStore,
                     ) -> None:
         self.model.train()
 
+        # generate batches of complete sequences, either all of them, or a sample by frequency of unique sequences
+        if self.params.sample_by_frequency:
+            batches = batch_store.gen_sampled_batches(self.params.batch_size)
+        else:
+            batches = batch_store.gen_batches(self.params.batch_size)
+
         num_batches = 0
-        for seq_b in self.gen_batches(seq_num):  # generates batches of complete sequences
+        for seq_b in batches:
 
             # forward step
-            input_ids = torch.LongTensor(seq_b).cuda()[:, :-1]
+            input_ids = seq_b[:, :-1]
             logits = self.model(input_ids)  # logits at all time steps [batch_size * seq_len, vocab_size]
 
             # backward step
             self.optimizer.zero_grad()  # sets all gradients to zero
-            labels = torch.LongTensor(seq_b).cuda()[:, 1:]
+            labels = seq_b[:, 1:]
             labels = torch.flatten(labels)
             loss = self.criterion(logits,  # [batch_size * seq_len, vocab_size]
                                   labels)  # [batch_size * seq_len]
@@ -191,7 +277,10 @@ class RNN:
               save_inferences_during_training: bool = True,
               ):
 
-        self.model.cuda()  # call this before constructing optimizer
+        # call this before constructing optimizer.
+        # parameters are float32 and, after flattening, in one contiguous block, which is fastest for small models
+        self.model.to(self.device, dtype=torch.float32)
+        self.model.rnn.flatten_parameters()
         self.criterion = torch.nn.CrossEntropyLoss()
         self.optimizer = torch.optim.Adagrad(self.model.parameters(),
                                              lr=self.params.learning_rate,
@@ -213,17 +302,22 @@ class RNN:
         print(f'Num sequences in valid={len(valid_seq_num):,}')
         print(f'Num sequences in test ={len(test_seq_num):,}')
 
-        # get unique sequences in train data for evaluating train_pp
-        train_seq_num_unique = []
-        for s in train_seq_num:
-            if s not in train_seq_num_unique:
-                train_seq_num_unique.append(s)
+        # get unique sequences in train data and their counts, for evaluating train_pp (and sampling by frequency)
+        train_seq_num_unique, train_counts = count_unique_sequences(train_seq_num)
         print(f'Num unique sequences in train ={len(train_seq_num_unique):,}')
 
+        # convert sequences to tensors once
+        train_unique_store = BatchStore(train_seq_num_unique, self.device, train_counts)
+        if self.params.sample_by_frequency:
+            train_store = train_unique_store  # repeated sequences are never stored
+        else:
+            train_store = BatchStore(train_seq_num, self.device)
+        valid_store = BatchStore(valid_seq_num, self.device)
+
         if calc_pp_train_during_training:
-            pp_train = self.calc_pp(train_seq_num_unique, verbose)
+            pp_train = self.calc_pp(train_unique_store, verbose)
             self.performance['epoch'].append(0)
-            self.performance['pp_train'].append(pp_train)
+            self.performance['pp_train_per_token'].append(pp_train)
             print(f'Train perplexity at epoch {0}: {pp_train:8.2f}')
 
         # save during-training results to disk (for plotting learning curves)
@@ -240,34 +334,34 @@ class RNN:
                 print(f'Epoch {epoch:>6}', flush=True)
 
             # train on one epoch
-            self.train_epoch(train_seq_num)
+            self.train_epoch(train_store)
 
             # save during-training results to disk (for plotting learning curves)
             if save_inferences_during_training:
                 self.fill_in_blank_df_and_save(epoch)
 
             if self.params.train_percent < 1.0:
-                pp_val = self.calc_pp(valid_seq_num, verbose)
-                self.performance['pp_val'].append(pp_val)
+                pp_val = self.calc_pp(valid_store, verbose)
+                self.performance['pp_val_per_token'].append(pp_val)
                 if verbose:
                     print(f'Validation perplexity at epoch {epoch}: {pp_val:8.2f}')
 
             if calc_pp_train_during_training:
-                pp_train = self.calc_pp(train_seq_num_unique, verbose)
-                self.performance['pp_train'].append(pp_train)
+                pp_train = self.calc_pp(train_unique_store, verbose)
+                self.performance['pp_train_per_token'].append(pp_train)
                 print(f'Train perplexity at epoch {epoch}: {pp_train:8.2f}')
 
             if not verbose:
                 pbar.update()
 
         if self.params.train_percent < 1.0:
-            pp_val = self.calc_pp(valid_seq_num, verbose)
+            pp_val = self.calc_pp(valid_store, verbose)
             if verbose:
                 print(f'Validation perplexity after training: {pp_val:8.2f}')
 
         if calc_pp_train_after_training:
-            pp_train = self.calc_pp(train_seq_num, verbose)
-            self.performance['pp_train'].append(pp_train)
+            pp_train = self.calc_pp(train_unique_store, verbose)
+            self.performance['pp_train_per_token'].append(pp_train)
             self.performance['epoch'].append(self.performance['epoch'][-1] + 1)
             print(f'Train perplexity after training: {pp_train:8.2f}')
 
@@ -299,7 +393,7 @@ class RNN:
 
         with torch.no_grad():
             x_b = [[self.token2id[t] for t in tokens] for tokens in seq_tok_eval]
-            logits = self.model.predict_next_token(input_ids=torch.LongTensor(x_b).cuda())
+            logits = self.model.predict_next_token(input_ids=torch.tensor(x_b, dtype=torch.long, device=self.device))
             logits_batch = logits.cpu().numpy()  # logits at last time step, [batch_size=8, vocab_size]
 
         for tokens, logits in zip(seq_tok_eval, logits_batch):
@@ -332,19 +426,37 @@ class RNN:
         """
         use language modeling based prediction task to calculate "native" sr scores
         """
+        return self.calc_native_sr_scores_batch([(verb, theme)], instruments, verbose)[0].tolist()
+
+    def calc_native_sr_scores_batch(self,
+                                    verb_phrases: List[Tuple[str, str]],
+                                    instruments: List[str],
+                                    verbose: bool = True,
+                                    ) -> np.array:
+        """
+        calculate "native" sr scores for all verb phrases at once, [num_verb_phrases, num_instruments].
+
+        all inputs have the same length, so that they are scored in one forward pass,
+        and the logits of the instruments are gathered on the device, before a single copy to the host.
+        """
 
         # TODO does Agent need to be in input to perform well on exp2b?
 
         # prepare input
-        token_ids = [self.token2id['John'], self.token2id[verb], self.token2id[theme]]
-        if 'with' in self.token2id:
-            token_ids.append(self.token2id['with'])
+        x_b = []
+        for verb, theme in verb_phrases:
+            token_ids = [self.token2id['John'], self.token2id[verb], self.token2id[theme]]
+            if 'with' in self.token2id:
+                token_ids.append(self.token2id['with'])
+            x_b.append(token_ids)
+        instrument_ids = [self.token2id[instrument] for instrument in instruments]
 
         # get logits (at last time step)
         with torch.no_grad():
-            x_b = [token_ids]
-            logits_at_last_step = self.model.predict_next_token(torch.LongTensor(x_b).cuda())  # [1, vocab_size]
-            logits_at_last_step = logits_at_last_step.squeeze()  # [vocab_size]
+            x_b = torch.tensor(x_b, dtype=torch.long, device=self.device)
+            logits_at_last_step = self.model.predict_next_token(x_b)  # [num_verb_phrases, vocab_size]
+            instrument_ids = torch.tensor(instrument_ids, dtype=torch.long, device=self.device)
+            res = logits_at_last_step[:, instrument_ids].cpu().numpy()  # [num_verb_phrases, num_instruments]
 
         # these are printed to console
         exp_vps = {'preserve pepper',
@@ -359,22 +471,15 @@ class RNN:
         vps = {'grow potato',
                }
 
-        # get scores
-        scores = []
-        instrument2sr = {}
-        for instrument in instruments:
-            token_id = self.token2id[instrument]
-            sr = logits_at_last_step[token_id].item()
-            scores.append(sr)
-            instrument2sr[instrument] = sr
-
-        for instrument, sr in sorted(instrument2sr.items(), key=lambda i: i[1]):
-            if verbose and verb + ' ' + theme in vps:
-                print(f'{verb} {theme} {instrument:>12} : {sr: .4f}')
-        if verbose and verb + ' ' + theme in vps:
-            print()
+        if verbose:
+            for (verb, theme), scores in zip(verb_phrases, res):
+                if verb + ' ' + theme not in vps:
+                    continue
+                for instrument, sr in sorted(zip(instruments, scores.tolist()), key=lambda i: i[1]):
+                    print(f'{verb} {theme} {instrument:>12} : {sr: .4f}')
+                print()
 
-        return scores
+        return res
 
     def fill_in_blank_df_and_save(self, epoch: int):
         """
@@ -388,10 +493,12 @@ class RNN:
 
         df_results = self.df_blank.copy()
 
-        for verb_phrase, row in self.df_blank.iterrows():
+        # score all verb phrases at once
+        verb_phrases = [tuple(verb_phrase.split()) for verb_phrase in self.df_blank.index]
+        scores_all = self.calc_native_sr_scores_batch(verb_phrases, self.instruments).tolist()
+
+        for (verb_phrase, row), scores in zip(self.df_blank.iterrows(), scores_all):
             verb_phrase: str
-            verb, theme = verb_phrase.split()
-            scores = self.calc_native_sr_scores(verb, theme, self.instruments)
             df_results.loc[verb_phrase] = [row['verb-type'], row['theme-type'], row['phrase-type'], row['location-type']] + scores
 
         df_results.to_csv(self.save_path / f'df_sr_{epoch:06}.csv')
@@ -444,6 +551,18 @@ class TorchRNN(torch.nn.Module):
 
         return logits
 
+    @torch.no_grad()
+    def calc_loss_per_sequence(self, seq_ids):
+        """
+        return the summed cross-entropy of predicting each next token, for each sequence, [batch_size].
+
+        runs without autograd, so that no activations are kept for a backward pass.
+        """
+        logits = self(seq_ids[:, :-1])  # [batch_size * seq_len, vocab_size]
+        labels = torch.flatten(seq_ids[:, 1:])  # [batch_size * seq_len]
+        loss = torch.nn.functional.cross_entropy(logits, labels, reduction='none')
+        return loss.view(len(seq_ids), -1).sum(dim=1, dtype=torch.float64)
+
     def forward(self, input_ids):
         embeds = self.wx(input_ids)
         outputs, hidden = self.rnn(embeds)  # this returns all time steps
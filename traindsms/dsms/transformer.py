@@ -6,7 +6,7 @@ Based on https://github.com/huggingface/transformers/blob/master/examples/pytorc
 """
 from transformers import GPT2LMHeadModel, GPT2Config
 from transformers import Trainer, TrainingArguments
-from typing import List, Dict
+from typing import List, Dict, Tuple
 import torch
 import numpy as np
 from datasets import Dataset
@@ -14,6 +14,7 @@ import pandas as pd
 from pathlib import Path
 
 from traindsms.params import TransformerParams
+from traindsms.dsms.device import get_device
 
 PAD = '<pad>'
 
@@ -40,6 +41,11 @@ class Transformer:
         self.vocab_size = len(self.token2id)
 
         self.id2token = {i: token for token, i in self.token2id.items()}
+        self.device = get_device(self.params.device)
+        if self.device.type == 'cuda' and self.device.index not in (None, 0):
+            # the Trainer always trains on the first visible gpu
+            raise ValueError(f'Cannot train transformer on device={self.device}. '
+                             f'Use device="cuda" and select the gpu with CUDA_VISIBLE_DEVICES instead.')
 
         # no gpt2 tokenizer needed because vocab is defined by corpus
 
@@ -83,6 +89,7 @@ class Transformer:
                                           evaluation_strategy='epoch',  # compute loss on eval dataset every epoch
                                           do_train=True,
                                           disable_tqdm=True,
+                                          no_cuda=self.device.type != 'cuda',
                                           )
 
         # padding and attention mask
@@ -96,10 +103,10 @@ class Transformer:
             padded[:len(seq_num_i)] = seq_num_i
             input_ids = padded
             attention_mask = np.array(input_ids != self.token2id[PAD], dtype=np.int32)
-            # collect
-            input_ids_all.append(torch.LongTensor(input_ids).cuda())
-            labels_all.append(torch.LongTensor(input_ids).cuda())
-            attention_mask_all.append(torch.LongTensor(attention_mask).cuda())
+            # collect (Trainer moves each batch to the device)
+            input_ids_all.append(torch.LongTensor(input_ids))
+            labels_all.append(torch.LongTensor(input_ids))
+            attention_mask_all.append(torch.LongTensor(attention_mask))
 
         # make dataset for Trainer
         data_in_dict = {'input_ids': input_ids_all,
@@ -137,7 +144,7 @@ class Transformer:
         # evaluate predictions
         for tokens in seq_tok_eval:
             token_ids = [self.token2id[t] for t in tokens]
-            outputs = self.model(input_ids=torch.LongTensor(token_ids).cuda())
+            outputs = self.model(input_ids=torch.LongTensor(token_ids).to(self.model.device))
             logits = outputs['logits'].detach().cpu().numpy()  # [seq_len, vocab_size]
             print([f'{self.id2token[i]:>12}' for i in token_ids])
             print([f'{" ":>12}'] + [f'{self.id2token[i]:>12}' for i in np.argmax(logits, axis=1)])
@@ -176,28 +183,37 @@ class Transformer:
         """
         use language modeling based prediction task to calculate "native" sr scores
         """
+        return self.calc_native_sr_scores_batch([(verb, theme)], instruments)[0].tolist()
+
+    def calc_native_sr_scores_batch(self,
+                                    verb_phrases: List[Tuple[str, str]],
+                                    instruments: List[str],
+                                    ) -> np.array:
+        """
+        calculate "native" sr scores for all verb phrases in one forward pass, [num_verb_phrases, num_instruments].
+
+        all inputs have the same length, so that no padding is needed.
+        """
 
         # todo does the model need an agent in the input?
 
         # prepare input
-        token_ids = [self.token2id['John'], self.token2id[verb], self.token2id[theme]]
-        if 'with' in self.token2id:
-            token_ids.append(self.token2id['with'])
-
-        # get logits
+        input_ids = []
+        for verb, theme in verb_phrases:
+            token_ids = [self.token2id['John'], self.token2id[verb], self.token2id[theme]]
+            if 'with' in self.token2id:
+                token_ids.append(self.token2id['with'])
+            input_ids.append(token_ids)
+        instrument_ids = [self.token2id[instrument] for instrument in instruments]
+
+        # get logits at the last position, and gather the instruments before copying to the host
         with torch.no_grad():
-            outputs = self.model(input_ids=torch.LongTensor(token_ids).cuda())
-        logits = outputs['logits']  # (seq_len, vocab_size)
-        logits_at_with = logits[-1].cpu().numpy()
+            outputs = self.model(input_ids=torch.tensor(input_ids, dtype=torch.long, device=self.model.device))
+            logits = outputs['logits']  # (num_verb_phrases, seq_len, vocab_size)
+            instrument_ids = torch.tensor(instrument_ids, dtype=torch.long, device=self.model.device)
+            res = logits[:, -1, instrument_ids].cpu().numpy()
 
-        scores = []
-        for instrument in instruments:
-
-            token_id = self.token2id[instrument]
-            sr = logits_at_with[token_id].item()
-            scores.append(sr)
-
-        return scores
+        return res
 
     def fill_in_blank_df_and_save(self, epoch: int):
         """
@@ -209,9 +225,11 @@ class Transformer:
 
         df_results = self.df_blank.copy()
 
-        for verb_phrase, row in self.df_blank.iterrows():
-            verb, theme = verb_phrase.split()
-            scores = self.calc_native_sr_scores(verb, theme, self.instruments)
+        # score all verb phrases at once
+        verb_phrases = [tuple(verb_phrase.split()) for verb_phrase in self.df_blank.index]
+        scores_all = self.calc_native_sr_scores_batch(verb_phrases, self.instruments).tolist()
+
+        for (verb_phrase, row), scores in zip(self.df_blank.iterrows(), scores_all):
             df_results.loc[verb_phrase] = [row['verb-type'], row['theme-type'], row['phrase-type'], row['location-type']] + scores
 
         df_results.to_csv(self.save_path / f'df_sr_{epoch:06}.csv')
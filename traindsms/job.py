@@ -16,6 +16,8 @@ from traindsms.dsms.rnn import RNN
 from traindsms.dsms.transformer import Transformer
 from traindsms.dsms.ctn import CTN
 from traindsms.dsms.lon import LON
+from traindsms.dsms import network
+from traindsms.dsms.device import set_num_cpu_threads
 
 
 def main(param2val):
@@ -27,6 +29,9 @@ def main(param2val):
     params = Params.from_param2val(param2val)
     print(params)
 
+    # threads used by torch on cpu - this is process-wide, so it is set once, here
+    set_num_cpu_threads()
+
     save_path = Path(param2val['save_path'])
 
     # in case job is run locally, we must create save_path
@@ -94,21 +99,37 @@ def main(param2val):
     dsm.train()
     print(f'Completed training the DSM', flush=True)
 
+    # export graphical models for debugging
+    if (isinstance(dsm, LON) or isinstance(dsm, CTN)) and network.EXPORT_GRAPH:
+        dsm.export_graph(save_path)
+
+    # score graphical models - spreading activation from all verbs and themes at once
+    if isinstance(dsm, LON) or isinstance(dsm, CTN):
+        verb_phrases = [tuple(verb_phrase.split()) for verb_phrase in df_blank.index]
+        if network.PRECOMPUTE_ACTIVATIONS:
+            sources, excluded_edges_list = dsm.get_verb_phrase_sources(verb_phrases)
+            dsm.precompute_activations(sources, excluded_edges_list, instruments, save_path)
+        vp2scores = dict(zip(df_blank.index, dsm.calc_sr_scores_batch(verb_phrases, instruments)))
+        print(f'Activation cache: {dsm.activation_cache_info()}', flush=True)
+    # score spatial models with next-word prediction - all verb phrases in one forward pass
+    elif params.composition_fn == 'native':
+        verb_phrases = [tuple(verb_phrase.split()) for verb_phrase in df_blank.index]
+        vp2scores = dict(zip(df_blank.index, dsm.calc_native_sr_scores_batch(verb_phrases, instruments).tolist()))
+    else:
+        vp2scores = {}
+
     # fill in blank data frame with semantic-relatedness scores
     for verb_phrase, row in df_blank.iterrows():
         verb, theme = verb_phrase.split()
 
-        # score graphical models
-        if isinstance(dsm, LON) or isinstance(dsm, CTN):
-            scores = dsm.calc_sr_scores(verb, theme, instruments)
+        # score graphical models, and spatial models with next-word prediction
+        if isinstance(dsm, LON) or isinstance(dsm, CTN) or params.composition_fn == 'native':
+            scores = vp2scores[verb_phrase]
 
         # score spatial models
         else:
-            # use next-word prediction to compute sr scores
-            if params.composition_fn == 'native':
-                scores = dsm.calc_native_sr_scores(verb, theme, instruments)
             # compute sr score for each constituent separately, then combine
-            elif params.composition_fn == 'componential':
+            if params.composition_fn == 'componential':
                 scores = calc_sr_cores_from_spatial_model_componential(dsm, verb, theme, instruments)
             # compose vectors, and then compute sr score
             else:
@@ -129,6 +129,10 @@ elif DSM_NAME == 'rnn':
         'weight_decay': 0.0,        # keep at 0
         # evaluation
         'embeddings_location': 'wx',
+        # sampling
+        'sample_by_frequency': False,  # if True, each epoch is sampled from unique sequences, by their frequency
+        # hardware
+        'device': None,             # e.g. 'cpu' or 'cuda', if None, chosen from the environment
     }
 
 elif DSM_NAME == 'transformer':
@@ -150,7 +154,8 @@ elif DSM_NAME == 'transformer':
         'adam_epsilon': 1e-08,          # default, robust to small changes
         'label_smoothing': 0.0,         # default, robust to small changes
         'initializer_range': 0.002,     # 0.002 is best and is default
-
+        # hardware
+        'device': None,                 # e.g. 'cpu' or 'cuda', if None, chosen from the environment
     }
 
 elif DSM_NAME == 'lon':
@@ -232,8 +237,8 @@ if DSM_NAME == 'lon':
     if 'context_size' in param2requests:
         for context_size in param2requests['context_size']:
             context_size: int
-            if context_size not in {1, 2}:
-                raise ValueError('LON requires a context_size of 1 or 2')
+            if context_size < 1:
+                raise ValueError('LON requires a context_size of at least 1')
 
 if DSM_NAME == 'w2v':
     if 'composition_fn' in param2requests:
@@ -246,6 +251,11 @@ if DSM_NAME == 'w2v':
             raise ValueError('Word2vec does not implement composition_fn=native')
 
 if DSM_NAME == 'count':
+    if 'reduce_type' in param2requests:
+        for reduce_type in param2requests['reduce_type']:
+            reduce_type: Tuple[Optional[str], Optional[int]]
+            if reduce_type[0] not in {'svd', 'rsvd', 'tsvd', 'rva', 'srva', None}:
+                raise ValueError('Count models require reduce_type to be one of svd, rsvd, tsvd, rva, srva or None')
     if 'composition_fn' in param2requests:
         for comp_fn in param2requests['composition_fn']:
             comp_fn: str
@@ -281,7 +291,7 @@ class CountParams:
     # ('ww', 'concatenated',  4,  'linear')
     # ('wd', None, None, None)
     norm_type: Optional[str]  # e.g. None, 'row_sum', 'row_logentropy', 'tf_idf', 'ppmi'
-    reduce_type: Tuple[Optional[str], Optional[int]]  # e.g. ('svd', 200) or (None, None)
+    reduce_type: Tuple[Optional[str], Optional[int]]  # e.g. ('svd', 200), ('rsvd', 200), ('rva', 200) or (None, None)
 
     @classmethod
     def from_param2val(cls, param2val):
@@ -307,6 +317,10 @@ class RNNParams:
     weight_decay: float
     # evaluation
     embeddings_location: str
+    # sampling
+    sample_by_frequency: bool = False  # if True, each epoch is sampled from unique sequences, by their frequency
+    # hardware
+    device: Optional[str] = None  # e.g. 'cpu' or 'cuda', if None, chosen from the environment
 
     @classmethod
     def from_param2val(cls, param2val):
@@ -333,6 +347,8 @@ class TransformerParams:
     adam_epsilon: float
     label_smoothing: float
     initializer_range: float
+    # hardware
+    device: Optional[str] = None  # e.g. 'cpu' or 'cuda', if None, chosen from the environment
 
     @classmethod
     def from_param2val(cls, param2val):
@@ -378,7 +394,7 @@ class CTNParams:
 @dataclass
 class LONParams:
     excluded_tokens: Optional[Tuple[str]]
-    context_size: Optional[int]  # only 1 or 2
+    context_size: Optional[int]  # number of following words each word is connected to
 
     # count_type: Tuple[str, Optional[str], Optional[int], Optional[str]]
     # norm_type: Optional[str]  # e.g. None, 'row_sum', 'row_logentropy', 'tf_idf', 'ppmi'
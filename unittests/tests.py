@@ -1,8 +1,239 @@
+import math
+import os
+import tempfile
 import unittest
+from unittest import mock
+import networkx as nx
 import numpy as np
+import torch
+from pathlib import Path
+from scipy import sparse
 
-from traindsms.params import CountParams
+from traindsms.params import CountParams, CTNParams, LONParams, RandomControlParams, RNNParams
 from traindsms.dsms.count import CountDSM
+from traindsms.dsms.count import load_or_compute_svd, reduce, reduce_svd, reduce_rva
+from traindsms.dsms.count import norm_rowsum, norm_col_sum, norm_tfidf, norm_ppmi, row_log_entropy
+from traindsms.dsms.ctn import CTN, get_leaf_distances
+from traindsms.dsms.device import get_device, DEVICE_ENV_NAME
+from traindsms.dsms.graph import CSRGraph
+from traindsms.dsms.lon import LON
+from traindsms.dsms.random_control import RandomControlDSM
+from traindsms.dsms.rnn import RNN, BatchStore, count_unique_sequences
+
+try:
+    from traindsms.dsms.transformer import Transformer
+    from traindsms.params import TransformerParams
+except ImportError:  # transformers and datasets are only needed for the transformer test
+    Transformer = None
+
+
+# ////////////////////////////////////////////////// reference (loop-based) normalizations
+
+
+def loop_rowsum(input_matrix):
+    res = np.zeros_like(input_matrix, float)
+    for i in range(input_matrix.shape[0]):
+        if input_matrix[i, :].sum() != 0:
+            res[i, :] = input_matrix[i, :] / input_matrix[i, :].sum()
+    return res
+
+
+def loop_col_sum(input_matrix):
+    return loop_rowsum(input_matrix.T).T
+
+
+def loop_tfidf(input_matrix):
+    nd = input_matrix.shape[1]
+    res = np.zeros_like(input_matrix, float)
+    for i in range(input_matrix.shape[0]):
+        df = np.count_nonzero(input_matrix[i, :])
+        idf = np.log((nd + 1) / (df + 1)) + 1
+        for j in range(nd):
+            tf = np.log(1 + input_matrix[i, j])  # the original loop read from the all-zero result matrix here
+            res[i, j] = tf * idf
+    return res
+
+
+def loop_ppmi(input_matrix):
+    row_sums = input_matrix.sum(1)
+    col_sums = input_matrix.sum(0)
+    matrix_sum = row_sums.sum()
+    res = np.zeros_like(input_matrix, float)
+    for i in range(input_matrix.shape[0]):
+        for j in range(input_matrix.shape[1]):
+            if input_matrix[i, j] == 0 or row_sums[i] == 0 or col_sums[j] == 0:
+                continue
+            top = input_matrix[i, j] / matrix_sum
+            bottom = (row_sums[i] / matrix_sum) * (col_sums[j] / matrix_sum)
+            div = top / bottom
+            if div > 1:
+                res[i, j] = np.log(div)
+    return res
+
+
+def loop_row_log_entropy(input_matrix):
+    row_prob_matrix = loop_rowsum(input_matrix)
+    log_frequencies = np.log(input_matrix + 1)
+    res = np.zeros_like(input_matrix, float)
+    for i in range(input_matrix.shape[0]):
+        row_entropy = np.dot(row_prob_matrix[i, :], np.log(1 / (1 + row_prob_matrix[i, :])))
+        res[i, :] = log_frequencies[i, :] * row_entropy
+    return res
+
+
+# ////////////////////////////////////////////////// reference (networkx and loop-based) graph algorithms
+
+
+def loop_adjacency_matrix(dsm):
+    """the row-normalized adjacency matrix, as built from a networkx graph before the network was stored as CSR"""
+    network = nx.DiGraph() if dsm.network.is_directed() else nx.Graph()
+    network.add_nodes_from(dsm.node_list)
+    network.add_weighted_edges_from(dsm.network.edges())
+    adj_mat = nx.adjacency_matrix(network, nodelist=dsm.node_list).toarray()
+    adj_mat = adj_mat + np.transpose(adj_mat)
+    res = np.zeros_like(adj_mat, float)
+    for i in range(len(adj_mat)):
+        if adj_mat[i].sum() != 0:
+            res[i] = adj_mat[i] / adj_mat[i].sum()
+    return res
+
+
+def loop_spread_activation(dsm, source, excluded_edges):
+    """spread activation with a dense adjacency matrix and a loop over nodes, as before it was vectorized"""
+    adj_mat = loop_adjacency_matrix(dsm)
+    length = adj_mat.shape[0]
+
+    activation = np.zeros((1, length), float)
+    fired = np.ones((1, length), float)
+    activation[0, dsm.node_list.index(source)] = 1  # source is activated
+    fired[0, dsm.node_list.index(source)] = 0  # source has fired
+    for edge in excluded_edges:
+        from_id = dsm.node_list.index(edge[0])
+        to_id = dsm.node_list.index(edge[1])
+        adj_mat[from_id, to_id] = 0
+        fired[0, to_id] = 0  # avoided node is considered as fired
+    activation_recorder = activation
+    last_fired = np.zeros((1, length), float)
+
+    for _ in range(length + 1):  # nodes that are not reached by then cannot be reached
+        if not (fired.any() or last_fired.any()):
+            break
+        activation = activation @ adj_mat
+        activation_recorder = activation_recorder + np.multiply(fired, activation) + \
+                              np.multiply(last_fired, activation)
+        last_fired = np.zeros((1, length), float)
+        for i in range(length):
+            if fired[0, i] == 1 and activation[0, i] != 0:
+                fired[0, i] = 0
+                last_fired[0, i] = 1
+
+    return activation_recorder[0]
+
+
+def nx_leaf_distances(tree):
+    """number of edges between each pair of leaves, by shortest paths in a networkx graph of the tree"""
+    graph = nx.Graph()
+    leaf_ids = []
+
+    def walk(node, parent_id):
+        node_id = graph.number_of_nodes()  # nodes are identified by position, so that repeated words are distinct
+        graph.add_node(node_id)
+        if parent_id is not None:
+            graph.add_edge(parent_id, node_id)
+        if type(node) == str:
+            leaf_ids.append(node_id)
+        else:
+            for child in node:
+                walk(child, node_id)
+
+    walk(tree, None)
+    return np.array([[nx.shortest_path_length(graph, i, j) for j in leaf_ids] for i in leaf_ids])
+
+
+def loop_ctn_edges(dsm):
+    """nodes, and weighted edges between nested tuples, counted one tree at a time, as before interning"""
+    network_nodes = set()
+    edge2count = {}
+    for tree in dsm.seq_parsed:
+        edges, nodes = dsm.complete_tree(tree)
+        network_nodes.update(nodes)
+        for edge in edges:
+            edge2count[edge] = edge2count.get(edge, 0) + 1
+    return network_nodes, {edge: math.log10(count + 1) for edge, count in edge2count.items()}
+
+
+def loop_constituent_weight_matrix(dsm):
+    """weights between words, computed one tree at a time on a networkx graph of the tree, as before interning"""
+    weight_matrix = np.zeros((dsm.num_vocab, dsm.num_vocab), float)
+    for tree in dsm.seq_parsed:
+        sent_edge, sent_node = dsm.complete_tree(tree)
+        graph = nx.Graph()
+        graph.add_edges_from(sent_edge)
+        sent_words = [node for node in sent_node if type(node) == str]
+        for word1 in sent_words:
+            for word2 in sent_words:
+                id1 = dsm.token2id[word1]
+                id2 = dsm.token2id[word2]
+                if id1 != id2:
+                    weight_matrix[id1][id2] += .5 ** (nx.shortest_path_length(graph, word1, word2) - 1)
+    return weight_matrix
+
+
+def loop_lexical_network(dsm, weight_matrix):
+    """normalized weights between words, and the networkx graph of words with a weight larger than zero"""
+    weight_normalizer = weight_matrix.sum(0)
+    for k in range(dsm.num_vocab):
+        if weight_normalizer[k] == 0:
+            weight_normalizer[k] = weight_normalizer[k] + 1
+
+    normalized_weights = np.zeros_like(weight_matrix)
+    lexical_network = nx.Graph()
+    for token_i, i in dsm.token2id.items():
+        for token_j, j in dsm.token2id.items():
+            w = weight_matrix[i][j] / (weight_normalizer[i] * weight_normalizer[j]) ** .5
+            normalized_weights[i, j] = w
+            if w > 0:
+                lexical_network.add_edge(token_i, token_j)
+    return normalized_weights, lexical_network
+
+
+CTN_TREES = [('John', (('grow', 'potato'), ('with', 'fertilizer'))),
+             ('John', (('spray', 'potato'), ('with', 'insecticide'))),
+             ('John', (('grow', 'strawberry'), ('with', 'fertilizer'))),
+             ('Mary', (('spray', 'strawberry'), ('with', 'insecticide'))),
+             ]
+
+# repeated trees, repeated words and repeated constituents within a tree
+CTN_TREES_WITH_REPEATS = CTN_TREES * 3 + [('John', (('grow', ('potato', 'potato')), ('with', 'John'))),
+                                          ('Mary', (('spray', 'strawberry'), ('with', 'insecticide'),
+                                                    ('with', 'insecticide'))),
+                                          'potato',
+                                          ]
+
+
+VERB_PHRASES = [('grow', 'potato'), ('spray', 'strawberry'), ('fill', 'fridge'), ('organize', 'plate'),
+                ('freeze', 'orange-juice'), ('consume', 'pudding'), ('grill', 'chicken'), ('catch', 'salmon')]
+INSTRUMENTS = ['fertilizer', 'insecticide', 'food', 'tray', 'ice', 'spoon', 'tongs', 'net']
+
+
+def make_native_corpus(num_sequences=200, seed=0):
+    """return token2id and sequences "John verb theme with instrument", with one instrument per verb phrase"""
+    vocab = ['John', 'with'] + [w for verb_phrase in VERB_PHRASES for w in verb_phrase] + INSTRUMENTS
+    token2id = {t: i for i, t in enumerate(vocab)}
+    rng = np.random.RandomState(seed)
+    seq_num = []
+    for i in rng.randint(0, len(VERB_PHRASES), size=num_sequences):
+        verb, theme = VERB_PHRASES[i]
+        seq_num.append([token2id[t] for t in ['John', verb, theme, 'with', INSTRUMENTS[i]]])
+    return token2id, seq_num
+
+
+def make_ctn(trees=CTN_TREES):
+    vocab = ('John', 'Mary', 'fertilizer', 'grow', 'insecticide', 'potato', 'spray', 'strawberry', 'with')
+    token2id = {t: n for n, t in enumerate(vocab)}
+    dsm = CTN(CTNParams(excluded_tokens=None), token2id, trees)
+    dsm.train()
+    return dsm
 
 
 class MyTest(unittest.TestCase):
@@ -33,6 +264,510 @@ class MyTest(unittest.TestCase):
         for i, j in zip(reduced_mat.flatten(), correct.flatten()):
             self.assertEqual(i, j)
 
+    def test_update_matrix_respects_sequence_boundary(self):
+
+        docs = ['the horse raced'.split(), 'past the barn'.split()]
+        vocab = tuple(sorted(set(docs[0] + docs[1])))
+        token2id = {t: n for n, t in enumerate(vocab)}
+        seq_num = [[token2id[token] for token in doc] for doc in docs]
+
+        param2val = {
+            'count_type': ['ww', 'forward', 4, 'flat'],
+            'norm_type': None,
+            'reduce_type': [None, None],
+        }
+        params = CountParams.from_param2val(param2val)
+        dsm = CountDSM(params, vocab, seq_num)
+
+        reduced_mat = dsm.train()
+        self.assertEqual(reduced_mat.sum(), 6)  # 3 pairs per sequence, none across sequences
+        self.assertEqual(reduced_mat[token2id['raced'], token2id['past']], 0)
+        self.assertEqual(seq_num[0], [token2id[token] for token in docs[0]])  # input is not padded in-place
+
+    def test_normalizations(self):
+
+        rng = np.random.default_rng(0)
+        count_matrix = rng.integers(0, 5, size=(20, 30)) * (rng.random((20, 30)) < 0.3)
+        count_matrix[3, :] = 0  # rows and columns with zero sum must not produce nan
+        count_matrix[:, 7] = 0
+
+        for norm_fn, loop_fn in [(norm_rowsum, loop_rowsum),
+                                 (norm_col_sum, loop_col_sum),
+                                 (norm_tfidf, loop_tfidf),
+                                 (norm_ppmi, loop_ppmi),
+                                 (row_log_entropy, loop_row_log_entropy),
+                                 ]:
+            correct = loop_fn(count_matrix)
+            dense_res = norm_fn(count_matrix)
+            sparse_res = norm_fn(sparse.csr_matrix(count_matrix))
+            self.assertTrue(sparse.issparse(sparse_res))
+            self.assertTrue(np.allclose(dense_res, correct), msg=norm_fn.__name__)
+            self.assertTrue(np.allclose(sparse_res.toarray(), correct), msg=norm_fn.__name__)
+
+    def test_svd_cache(self):
+
+        rng = np.random.default_rng(0)
+        input_matrix = sparse.csr_matrix(rng.integers(0, 5, size=(20, 30)).astype(float))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = Path(tmp_dir) / 'svd_cache' / 'key.npz'
+            u_computed, s_computed = load_or_compute_svd(input_matrix, 5, cache_path)
+            self.assertTrue(cache_path.exists())
+            self.assertEqual(u_computed.shape, (20, 5))  # only the requested number of components is cached
+            u_loaded, s_loaded = load_or_compute_svd(input_matrix, 5, cache_path)
+            self.assertTrue(np.array_equal(u_computed, u_loaded))
+            self.assertTrue(np.array_equal(s_computed, s_loaded))
+
+            # a smaller size is a slice of the cached decomposition, a larger size replaces it
+            u_small, s_small = load_or_compute_svd(input_matrix, 2, cache_path)
+            self.assertTrue(np.array_equal(u_small, u_computed[:, :2]))
+            u_large, s_large = load_or_compute_svd(input_matrix, 10, cache_path)
+            self.assertEqual(u_large.shape, (20, 10))
+            with np.load(cache_path) as npz_file:
+                self.assertEqual(npz_file['u'].shape, (20, 10))
+
+        correct = np.linalg.svd(input_matrix.toarray(), compute_uv=False)
+        self.assertTrue(np.allclose(s_large, correct[:10]))
+        for reduce_size in [2, 5, 10]:  # a slice of the cached decomposition equals a fresh reduction, up to sign
+            self.assertTrue(np.allclose(np.abs(u_large[:, :reduce_size]),
+                                        np.abs(reduce_svd(input_matrix.toarray(), reduce_size))))
+
+    def test_svd_backends(self):
+
+        rng = np.random.default_rng(0)
+        singular_values = np.array([10, 8, 6, 4, 2, 0.1, 0.1, 0.1])
+        input_matrix = (rng.normal(size=(40, 8)) * singular_values) @ rng.normal(size=(8, 60))
+        correct = reduce(input_matrix, 'svd', 5)
+
+        for reduce_type in ['svd', 'tsvd', 'rsvd']:
+            reduced_mat = reduce(sparse.csr_matrix(input_matrix), reduce_type, 5)
+            self.assertEqual(reduced_mat.shape, (40, 5))
+            self.assertTrue(np.allclose(np.abs(reduced_mat), np.abs(correct), atol=1e-6), msg=reduce_type)
+
+    def test_rva(self):
+
+        rng = np.random.default_rng(0)
+        input_matrix = rng.integers(0, 5, size=(20, 40)) * (rng.random((20, 40)) < 0.3)
+
+        # compare against accumulating random vectors one cell at a time
+        random_vectors = np.random.RandomState(0).normal(0.0, 1.0, [40, 8])
+        correct = np.zeros([20, 8])
+        for i in range(20):
+            for j in range(40):
+                correct[i, :] += input_matrix[i, j] * random_vectors[j, :]
+        self.assertTrue(np.allclose(reduce_rva(input_matrix, 8, seed=0, block_size=7), correct))
+        self.assertTrue(np.allclose(reduce_rva(sparse.csr_matrix(input_matrix), 8, seed=0), correct))
+
+        for projection in ['normal', 'achlioptas']:
+            res = reduce_rva(sparse.csr_matrix(input_matrix), 8, projection=projection, dtype=np.float32, seed=1)
+            self.assertEqual(res.dtype, np.float32)
+            self.assertEqual(res.shape, (20, 8))
+
+    def test_spread_activation_batch(self):
+
+        dsm = make_ctn()
+
+        sources = ['grow', 'potato', 'Mary']
+        excluded_edges_list = [[(('grow', 'potato'), 'potato')], [(('grow', 'potato'), 'grow')], []]
+        res = dsm.spread_activation_batch(sources, excluded_edges_list, batch_size=2)
+        for source, excluded_edges, row in zip(sources, excluded_edges_list, res):
+            correct = loop_spread_activation(dsm, source, excluded_edges)
+            self.assertTrue(np.allclose(dsm.spread_activation(source, excluded_edges), correct))
+            self.assertTrue(np.allclose(row, correct))
+            self.assertTrue(np.array_equal(row, dsm.spread_activation(source, excluded_edges)))
+
+        verb_phrases = [('grow', 'potato'), ('spray', 'strawberry'), ('grow', 'insecticide')]
+        instruments = ['fertilizer', 'insecticide']
+        correct = [dsm.calc_sr_scores(verb, theme, instruments) for verb, theme in verb_phrases]
+        self.assertEqual(dsm.calc_sr_scores_batch(verb_phrases, instruments), correct)
+
+    def test_spread_activation_disconnected(self):
+
+        seq_tok = [['John', 'grow', 'potato', 'with', 'fertilizer'],
+                   ['Mary', 'spray', 'strawberry', 'with', 'insecticide'],
+                   ['John', 'spray', 'potato'],
+                   ['tractor']]  # an isolated node
+        dsm = LON(LONParams(excluded_tokens=None, context_size=1), seq_tok)
+        dsm.train()
+
+        sources = ['grow', 'tractor', 'spray', 'grow']
+        excluded_edges_list = [[], [], [('spray', 'potato')], [('grow', 'potato'), ('John', 'spray')]]
+        res = dsm.spread_activation_batch(sources, excluded_edges_list, batch_size=3)
+        for source, excluded_edges, row in zip(sources, excluded_edges_list, res):
+            correct = loop_spread_activation(dsm, source, excluded_edges)
+            self.assertTrue(np.allclose(dsm.spread_activation(source, excluded_edges), correct))
+            self.assertTrue(np.allclose(row, correct))
+        self.assertEqual(res[1, dsm.node2id['tractor']], 1)  # activation of an isolated source goes nowhere
+        self.assertEqual(res[0, dsm.node2id['tractor']], 0)
+
+    def test_activation_cache(self):
+
+        dsm = make_ctn()
+        excluded_edges = [(('grow', 'potato'), 'potato')]
+        first = dsm.get_activation('grow', excluded_edges)
+        second = dsm.get_activation('grow', excluded_edges)
+        self.assertIs(first, second)
+        dsm.spread_activation_batch(['grow', 'grow', 'potato'], [excluded_edges, [], []])
+        self.assertEqual(dsm.activation_cache_info().hits, 2)
+        self.assertEqual(dsm.activation_cache_info().misses, 3)
+        for activation_recorder in dsm.activation_cache.values():
+            self.assertIsNone(activation_recorder.base)  # cached rows do not keep their batch in memory
+
+        dsm.invalidate_caches()
+        self.assertEqual(dsm.activation_cache_info().currsize, 0)
+        self.assertTrue(np.array_equal(dsm.get_activation('grow', excluded_edges), first))
+
+    def test_leaf_distances(self):
+
+        leaves, distances = get_leaf_distances(('John', (('grow', 'potato'), ('with', 'fertilizer'))))
+        self.assertEqual(leaves, ['John', 'grow', 'potato', 'with', 'fertilizer'])
+        correct = np.array([[0, 4, 4, 4, 4],
+                            [4, 0, 2, 4, 4],
+                            [4, 2, 0, 4, 4],
+                            [4, 4, 4, 0, 2],
+                            [4, 4, 4, 2, 0]])
+        self.assertTrue(np.array_equal(distances, correct))
+
+        for tree in [('John', (('grow', 'potato'), ('with', 'fertilizer'))),
+                     ('John', (('grow', ('potato', 'potato')), ('with', 'John'))),  # repeated words
+                     (('Mary', ('spray', ('strawberry', ('with', 'insecticide')))), 'John'),
+                     'potato']:
+            leaves, distances = get_leaf_distances(tree)
+            self.assertTrue(np.array_equal(distances, nx_leaf_distances(tree)), msg=tree)
+
+    def test_csr_graph(self):
+
+        nodes = ['a', 'b', 'c', 'd', 'e', 'f']  # f is isolated
+        edges = [('a', 'b', 1.0), ('b', 'a', 2.0), ('b', 'c', 0.5), ('c', 'c', 3.0), ('c', 'd', 1.5), ('e', 'd', 1.0),
+                 ('a', 'e', 0.25)]
+        node2id = {node: i for i, node in enumerate(nodes)}
+
+        for directed in [True, False]:
+            # an undirected graph cannot have edges in both directions
+            graph_edges = edges if directed else [edge for edge in edges if edge[:2] != ('b', 'a')]
+            edge_ids = np.array([[node2id[u], node2id[v]] for u, v, w in graph_edges])
+            graph = CSRGraph(nodes, edge_ids, np.array([w for u, v, w in graph_edges]), directed=directed)
+            correct = nx.DiGraph() if directed else nx.Graph()
+            correct.add_nodes_from(nodes)
+            correct.add_weighted_edges_from(graph_edges)
+            msg = f'directed={directed}'
+
+            self.assertEqual(graph.number_of_edges(), correct.number_of_edges(), msg=msg)
+            for node in nodes:
+                self.assertEqual(set(graph.successors(node)), set(correct.successors(node)) if directed
+                                 else set(correct.neighbors(node)), msg=msg)
+                self.assertEqual(set(graph.predecessors(node)), set(correct.predecessors(node)) if directed
+                                 else set(correct.neighbors(node)), msg=msg)
+                self.assertEqual(graph.degree(node), correct.degree(node), msg=msg)  # a loop counts twice
+                if directed:
+                    self.assertEqual(graph.out_degree(node), correct.out_degree(node), msg=msg)
+                    self.assertEqual(graph.in_degree(node), correct.in_degree(node), msg=msg)
+            for u, v, w in graph_edges:
+                self.assertEqual(graph.get_weight(u, v), w, msg=msg)
+                self.assertEqual(graph.has_edge(v, u), correct.has_edge(v, u), msg=msg)
+
+            # subgraph, in the order in which nodes are first given
+            subgraph = graph.subgraph(['c', 'b', 'c', 'a'])
+            correct_subgraph = correct.subgraph(['c', 'b', 'a'])
+            self.assertEqual(subgraph.nodes, ['c', 'b', 'a'], msg=msg)
+            edge_key = tuple if directed else frozenset  # undirected edges have no order
+            self.assertEqual({edge_key((u, v)): w for u, v, w in subgraph.edges()},
+                             {edge_key((u, v)): w for u, v, w in correct_subgraph.edges(data='weight')}, msg=msg)
+
+            # undirected view, which keeps the larger weight of edges in both directions
+            undirected = graph.to_undirected()
+            correct_undirected = correct.to_undirected()
+            self.assertFalse(undirected.is_directed())
+            self.assertEqual({frozenset((u, v)) for u, v, w in undirected.edges()},
+                             {frozenset(edge) for edge in correct_undirected.edges()}, msg=msg)
+            self.assertEqual(undirected.get_weight('a', 'b'), 2.0 if directed else 1.0, msg=msg)
+            self.assertEqual(undirected.get_weight('b', 'a'), undirected.get_weight('a', 'b'), msg=msg)
+
+            # shortest paths, with np.inf where there is no path
+            lengths = graph.shortest_path_lengths(nodes)
+            for i, source in enumerate(nodes):
+                source2length = nx.single_source_shortest_path_length(correct, source)
+                for j, target in enumerate(nodes):
+                    self.assertEqual(lengths[i, j], source2length.get(target, np.inf), msg=msg)
+
+            # diameter, which is only defined if the graph is connected
+            with self.assertRaises(ValueError):
+                undirected.diameter()
+            connected = undirected.subgraph(nodes[:-1])
+            self.assertEqual(connected.diameter(batch_size=2),
+                             nx.diameter(correct_undirected.subgraph(nodes[:-1])), msg=msg)
+            self.assertEqual(undirected.diameter(within_components=True), connected.diameter(), msg=msg)
+
+    def test_adjacency_matrix(self):
+
+        seq_tok = [['John', 'grow', 'potato', 'with', 'fertilizer'],
+                   ['potato', 'potato', 'grow', 'John'],
+                   ['Mary']]  # Mary is not connected to any node
+        lon = LON(LONParams(excluded_tokens=None, context_size=2), seq_tok)
+        lon.train()
+
+        for dsm in [lon, make_ctn()]:
+            adj_mat = dsm.adjacency_matrix
+            self.assertTrue(sparse.isspmatrix_csr(adj_mat))
+            self.assertTrue(np.allclose(adj_mat.toarray(), loop_adjacency_matrix(dsm)))
+
+        self.assertEqual(lon.adjacency_matrix[lon.node2id['Mary']].nnz, 0)  # row of isolated node is zero
+
+    def test_ctn_edges(self):
+
+        dsm = make_ctn(CTN_TREES_WITH_REPEATS)
+        correct_nodes, correct_edge2weight = loop_ctn_edges(dsm)
+
+        self.assertEqual(len(dsm.node_list), len(correct_nodes))  # each constituent is interned once
+        self.assertEqual(set(dsm.node_list), correct_nodes)
+        self.assertEqual({(u, v): w for u, v, w in dsm.network.edges()}, correct_edge2weight)
+        self.assertTrue(dsm.network.is_directed())
+
+    def test_ctn_word_weights(self):
+
+        dsm = make_ctn(CTN_TREES_WITH_REPEATS)
+        weight_matrix, _ = dsm.get_constituent_edge_weight()
+        self.assertTrue(np.array_equal(weight_matrix, loop_constituent_weight_matrix(dsm)))  # sums of powers of .5
+
+    def test_ctn_lexical_network(self):
+
+        dsm = make_ctn(CTN_TREES_WITH_REPEATS)
+        correct_weights, correct_network = loop_lexical_network(dsm, loop_constituent_weight_matrix(dsm))
+
+        self.assertTrue(np.allclose(dsm.lexical_matrix.toarray(), correct_weights))
+        self.assertEqual({frozenset((u, v)) for u, v, w in dsm.lexical_network.edges()},
+                         {frozenset(edge) for edge in correct_network.edges()})
+
+    def test_lon_edges(self):
+
+        seq_tok = [['John', 'grow', 'potato', 'with', 'fertilizer'],
+                   ['potato', 'potato', 'grow', 'John'],
+                   ['Mary']]
+
+        for context_size in [1, 3]:
+            dsm = LON(LONParams(excluded_tokens=None, context_size=context_size), seq_tok)
+            dsm.train()
+
+            # count edges between each token and the next context_size tokens, one by one
+            edge2count = {}
+            for seq in seq_tok:
+                for n in range(len(seq)):
+                    for token in seq[n + 1: n + 1 + context_size]:
+                        edge2count[(seq[n], token)] = edge2count.get((seq[n], token), 0) + 1
+
+            self.assertEqual(dsm.node_list, sorted({token for seq in seq_tok for token in seq}))
+            for (node1, node2), count in edge2count.items():
+                if edge2count.get((node2, node1)):
+                    continue  # the weight of one of both directions is kept
+                self.assertEqual(dsm.network.get_weight(node1, node2), np.log10(count + 1))
+            self.assertEqual(dsm.network.number_of_edges(), len({frozenset(edge) for edge in edge2count}))
+            self.assertEqual(dsm.get_weight_matrix().nnz, 2 * dsm.network.number_of_edges() - 1)  # one loop
+
+    def test_export_graph(self):
+
+        dsm = make_ctn()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dsm.export_graph(Path(tmp_dir))
+            edges = np.load(Path(tmp_dir) / 'edges.npz')
+            nodes = (Path(tmp_dir) / 'nodes.tsv').read_text().splitlines()[1:]
+
+        self.assertEqual(nodes, [f'{node_id}\t{node}' for node_id, node in enumerate(dsm.node_list)])
+        for from_id, to_id, weight in zip(edges['from_ids'], edges['to_ids'], edges['weights']):
+            self.assertEqual(dsm.network.get_weight(dsm.node_list[from_id], dsm.node_list[to_id]), weight)
+        self.assertEqual(len(edges['weights']), dsm.get_summary()['num_edges'])
+
+    def test_walk_activation(self):
+
+        dsm = make_ctn()
+        adj_mat = dsm.adjacency_matrix.toarray()
+
+        # enumerate every walk from the source, one by one
+        def walk(node_id, activation, num_edges):
+            correct[node_id] += activation
+            if num_edges < 3:
+                for next_id in np.flatnonzero(adj_mat[node_id]):
+                    walk(next_id, activation * adj_mat[node_id, next_id] * 0.5, num_edges + 1)
+
+        correct = np.zeros(len(dsm.node_list))
+        walk(dsm.node2id['grow'], 1.0, 0)
+
+        res = dsm.get_walk_activation(['potato', 'grow'], max_length=3, decay=0.5, batch_size=1)
+        self.assertTrue(np.allclose(res[1], correct))
+        self.assertTrue(res[0, dsm.node2id['potato']] >= 1.0)
+
+    def test_walk_activation_disconnected(self):
+
+        seq_tok = [['John', 'grow', 'potato', 'with', 'fertilizer'],
+                   ['Mary', 'spray', 'strawberry'],
+                   ['insecticide']]  # 3 connected components, one of which is an isolated node
+        dsm = LON(LONParams(excluded_tokens=None, context_size=1), seq_tok)
+        dsm.train()
+
+        with self.assertRaises(ValueError):
+            dsm.network.diameter()
+        network = dsm.network.to_networkx()
+        correct = max(nx.diameter(network.subgraph(nodes)) for nodes in nx.connected_components(network))
+        self.assertEqual(dsm.diameter, correct)
+
+        res = dsm.get_walk_activation()
+        self.assertTrue(np.allclose(res, dsm.get_walk_activation(max_length=2 * correct - 1)))
+        self.assertEqual(res[dsm.node2id['John'], dsm.node2id['Mary']], 0)  # no walk between components
+        self.assertEqual(res[dsm.node2id['insecticide'], dsm.node2id['insecticide']], 1)
+
+    def test_precompute_activations(self):
+
+        dsm = make_ctn()
+
+        verb_phrases = [('grow', 'potato'), ('spray', 'strawberry'), ('grow', 'potato')]
+        instruments = ['fertilizer', 'insecticide']
+        correct = dsm.calc_sr_scores_batch(verb_phrases, instruments)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sources, excluded_edges_list = dsm.get_verb_phrase_sources(verb_phrases)
+            dsm.precompute_activations(sources, excluded_edges_list, instruments, Path(tmp_dir), batch_size=2)
+            self.assertEqual(len(dsm.activation_table.key2row), 4)  # each source and its excluded edges only once
+
+            # the table holds the activations of the original spreading algorithm
+            target_ids = [dsm.node2id[instrument] for instrument in instruments]
+            correct_activations = [loop_spread_activation(dsm, source, excluded_edges)[target_ids]
+                                   for source, excluded_edges in zip(sources, excluded_edges_list)]
+            self.assertTrue(np.allclose(dsm.activation_table.get_activations(sources, excluded_edges_list, instruments),
+                                        correct_activations))
+
+            dsm.activation_cache.clear()
+            self.assertEqual(dsm.calc_sr_scores_batch(verb_phrases, instruments), correct)
+            self.assertEqual(len(dsm.activation_cache), 0)  # activations were read from the table
+
+            del dsm.activation_table  # release the memory-mapped file
+
+    def test_get_device(self):
+
+        num_threads = torch.get_num_threads()
+        with mock.patch.dict(os.environ, {DEVICE_ENV_NAME: 'cuda:1'}):
+            self.assertEqual(get_device('cpu'), torch.device('cpu'))  # params take precedence
+            self.assertEqual(get_device(None), torch.device('cuda:1'))
+        with mock.patch.dict(os.environ), mock.patch('torch.cuda.is_available', return_value=False):
+            os.environ.pop(DEVICE_ENV_NAME, None)
+            self.assertEqual(get_device(None), torch.device('cpu'))
+            with mock.patch('torch.cuda.is_available', return_value=True):
+                self.assertEqual(get_device(None), torch.device('cuda'))
+        self.assertEqual(torch.get_num_threads(), num_threads)  # no side effects
+
+    def test_batch_store(self):
+
+        rng = np.random.default_rng(0)
+        seq_num = [rng.integers(0, 10, size=rng.choice([2, 3, 5])).tolist() for _ in range(50)]
+        batch_store = BatchStore(seq_num, torch.device('cpu'))
+        tensors = {seq_len: tensor.clone() for seq_len, tensor in batch_store.length2tensor.items()}
+
+        for epoch in range(3):
+            yielded = []
+            for seq_b in batch_store.gen_batches(batch_size=4):
+                self.assertLessEqual(len(seq_b), 4)
+                yielded.extend(seq_b.tolist())  # all sequences in a batch have the same length
+            self.assertEqual(sorted(yielded), sorted(seq_num))  # each sequence exactly once per epoch
+
+        for seq_len, tensor in batch_store.length2tensor.items():
+            self.assertTrue(torch.equal(tensor, tensors[seq_len]))  # shuffling does not modify the stored tensors
+
+    def test_count_unique_sequences(self):
+
+        seq_num = [[1, 2, 3], [4, 5], [1, 2, 3], [1, 2], [4, 5], [1, 2, 3]]
+        seq_num_unique, counts = count_unique_sequences(seq_num)
+        self.assertEqual(seq_num_unique, [[1, 2, 3], [4, 5], [1, 2]])  # in order of first occurrence
+        self.assertEqual(counts.tolist(), [3, 2, 1])
+
+        seq_num_unique, counts = count_unique_sequences([])
+        self.assertEqual((seq_num_unique, len(counts)), ([], 0))
+
+    def test_count_weighted_perplexity(self):
+
+        rng = np.random.default_rng(0)
+        seq_num_unique = [rng.integers(0, 10, size=rng.choice([3, 4, 6])).tolist() for _ in range(20)]
+        seq_num = [seq_num_unique[i] for i in rng.integers(0, 20, size=200)]
+        params = RNNParams(rnn_type='lstm', embed_size=8, num_layers=1, train_percent=1.0, embed_init_range=0.5,
+                           dropout_prob=0.0, batch_size=16, num_epochs=1, learning_rate=0.1, grad_clip=None,
+                           lr_decay=0.0, weight_decay=0.0, embeddings_location='wx', device='cpu')
+        dsm = RNN(params, {str(i): i for i in range(10)}, seq_num)
+
+        # exp of mean cross-entropy of all predicted tokens in all sequences
+        with torch.no_grad():
+            losses = [torch.nn.functional.cross_entropy(dsm.model(torch.tensor([s[:-1]])), torch.tensor(s[1:]),
+                                                        reduction='sum').item() for s in seq_num]
+        correct = np.exp(np.sum(losses) / sum(len(s) - 1 for s in seq_num))
+
+        seq_num_unique, counts = count_unique_sequences(seq_num)
+        pp_all = dsm.calc_pp(BatchStore(seq_num, dsm.device), verbose=False)
+        pp_unique = dsm.calc_pp(BatchStore(seq_num_unique, dsm.device, counts), verbose=False)
+        self.assertTrue(np.isclose(pp_all, correct))
+        self.assertTrue(np.isclose(pp_unique, pp_all))
+
+    def test_native_sr_scores_batch(self):
+
+        dsm = RandomControlDSM(RandomControlParams(embed_size=2, distribution='uniform'), vocab=('grow', 'potato'))
+        verb_phrases = [('grow', 'potato'), ('spray', 'strawberry')]
+        instruments = ['fertilizer', 'insecticide', 'food']
+
+        np.random.seed(0)
+        correct = [dsm.calc_native_sr_scores(verb, theme, instruments) for verb, theme in verb_phrases]
+        np.random.seed(0)
+        res = dsm.calc_native_sr_scores_batch(verb_phrases, instruments)
+
+        self.assertEqual(res.shape, (len(verb_phrases), len(instruments)))
+        self.assertEqual(res.tolist(), correct)
+
+    def test_native_sr_scores_batch_rnn(self):
+
+        token2id, seq_num = make_native_corpus()
+        params = RNNParams(rnn_type='lstm', embed_size=8, num_layers=2, train_percent=1.0, embed_init_range=0.5,
+                           dropout_prob=0.0, batch_size=16, num_epochs=2, learning_rate=0.1, grad_clip=1.0,
+                           lr_decay=0.0, weight_decay=0.0, embeddings_location='wx', device='cpu')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dsm = RNN(params, token2id, seq_num, save_path=Path(tmp_dir))
+            dsm.train(verbose=False, calc_pp_train_during_training=False, save_inferences_during_training=False)
+
+        verb_phrases = VERB_PHRASES + VERB_PHRASES[:2]
+        res = dsm.calc_native_sr_scores_batch(verb_phrases, INSTRUMENTS, verbose=False)
+        self.assertEqual(res.shape, (len(verb_phrases), len(INSTRUMENTS)))
+
+        for (verb, theme), row in zip(verb_phrases, res):
+            # one forward pass per verb phrase, as before scoring was batched
+            with torch.no_grad():
+                x = torch.tensor([[token2id['John'], token2id[verb], token2id[theme], token2id['with']]])
+                logits = dsm.model.predict_next_token(x).squeeze().numpy()
+            correct = [logits[token2id[instrument]].item() for instrument in INSTRUMENTS]
+            self.assertTrue(np.allclose(row, correct, atol=1e-5))
+            self.assertTrue(np.allclose(row, dsm.calc_native_sr_scores(verb, theme, INSTRUMENTS, verbose=False),
+                                        atol=1e-5))
+
+    @unittest.skipIf(Transformer is None, 'transformers is not installed')
+    def test_native_sr_scores_batch_transformer(self):
+
+        token2id, seq_num = make_native_corpus()
+        params = TransformerParams(transformer_type='gpt2', embed_size=16, inner_size=4, resid_pdrop=0.0,
+                                   num_layers=1, num_heads=1, seq_len=8, batch_size=32, num_epochs=1,
+                                   learning_rate=0.005, weight_decay=0.0, adam_beta2=0.999, adam_epsilon=1e-08,
+                                   label_smoothing=0.0, initializer_range=0.002, device='cpu')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dsm = Transformer(params, dict(token2id), seq_num, df_blank=None, instruments=INSTRUMENTS,
+                              save_path=Path(tmp_dir), eos='with')
+            dsm.trainer.train()
+        dsm.model.eval()
+
+        verb_phrases = VERB_PHRASES + VERB_PHRASES[:2]
+        res = dsm.calc_native_sr_scores_batch(verb_phrases, INSTRUMENTS)
+        self.assertEqual(res.shape, (len(verb_phrases), len(INSTRUMENTS)))
+
+        for (verb, theme), row in zip(verb_phrases, res):
+            # one forward pass per verb phrase, as before scoring was batched
+            with torch.no_grad():
+                x = torch.LongTensor([token2id['John'], token2id[verb], token2id[theme], token2id['with']])
+                logits = dsm.model(input_ids=x.to(dsm.model.device))['logits'][-1].cpu().numpy()
+            correct = [logits[token2id[instrument]].item() for instrument in INSTRUMENTS]
+            self.assertTrue(np.allclose(row, correct, atol=1e-5))
+            self.assertTrue(np.allclose(row, dsm.calc_native_sr_scores(verb, theme, INSTRUMENTS), atol=1e-5))
+
 
 if __name__ == '__main__':
     unittest.main()